@@ -0,0 +1,197 @@
+import argparse
+import json
+import threading
+import pandas as pd
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llm_backends import BACKENDS
+
+
+DEFAULT_WORKER_URL = "http://127.0.0.1:8765"
+
+
+def frames_to_payload(df_list: list) -> list:
+    '''display_bsの表のリストをJSONに変換できる形にする'''
+    return [df.to_dict(orient="list") for df in df_list]
+
+
+def payload_to_frames(payload: list) -> list:
+    '''frames_to_payloadの逆変換'''
+    return [pd.DataFrame(data) for data in payload]
+
+
+def submit_analysis(df_list: list, url: str = DEFAULT_WORKER_URL, timeout: float = 3600,
+                    analysis: str = 'agent') -> str:
+    '''起動中のワーカーにバランスシートの分析を依頼する
+
+    :param df_list: list: display_bsの結果
+    :param url: str: ワーカーのURL
+    :param timeout: float: 待機する秒数
+    :param analysis: str: agent（ReActのエージェント）かfacts（比率を先に計算して一回の生成）
+    :return: str: 最終回答
+    '''
+
+    body = {"df_list": frames_to_payload(df_list), "analysis": analysis}
+    res = requests.post(f"{url}/analyze", json=body, timeout=timeout)
+    res.raise_for_status()
+    return res.json()["output"]
+
+
+def submit_batch_analysis(companies: dict, url: str = DEFAULT_WORKER_URL, batch_size: int = 8,
+                          timeout: float = 3600):
+    '''起動中のワーカーに複数の会社の分析を依頼し、終わった会社から順に結果を返す
+
+    :param companies: dict: {会社名かdocID: display_bsの結果}
+    :param url: str: ワーカーのURL
+    :param batch_size: int: 一度に生成する会社の数
+    :param timeout: float: 待機する秒数
+    :return: Iterator[Tuple[str, str]]: (会社名かdocID, 分析結果)
+    '''
+
+    body = {"companies": {name: frames_to_payload(df_list) for name, df_list in companies.items()},
+            "batch_size": batch_size}
+    with requests.post(f"{url}/analyze_batch", json=body, timeout=timeout, stream=True) as res:
+        res.raise_for_status()
+        for line in res.iter_lines(chunk_size=None):
+            if line:
+                result = json.loads(line)
+                if "error" in result:
+                    raise RuntimeError(result["error"])
+                yield result["name"], result["output"]
+
+
+def is_worker_alive(url: str = DEFAULT_WORKER_URL) -> bool:
+    try:
+        return requests.get(f"{url}/health", timeout=2).ok
+    except requests.RequestException:
+        return False
+
+
+class AnalyzerHandler(BaseHTTPRequestHandler):
+    '''/analyze でバランスシートの分析、/health で状態確認'''
+
+    protocol_version = "HTTP/1.1"  # 結果を順に返すためにchunkedで送る
+    analyzer = None
+    lock = threading.Lock()  # モデルは一つのため分析は一件ずつ行う
+
+    def _send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "model_id": self.analyzer.model_id,
+                                  "stats": self.analyzer.generator.stats()})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        if self.path == "/analyze_batch":
+            self._analyze_batch()
+            return
+        if self.path != "/analyze":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length))
+            df_list = payload_to_frames(body["df_list"])
+            with self.lock:
+                if body.get("analysis") == "facts":
+                    output = self.analyzer.facts_analyze(df_list)
+                else:
+                    output = self.analyzer.agent_analyze(df_list)
+            self._send_json(200, {"output": output})
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+
+    def _analyze_batch(self) -> None:
+        '''一社ごとの結果をJSON Linesで順に返す'''
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length))
+        companies = {name: payload_to_frames(payload) for name, payload in body["companies"].items()}
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            with self.lock:
+                for name, output in self.analyzer.batch_analyze(companies, body.get("batch_size", 8)):
+                    self._write_chunk({"name": name, "output": output})
+        except Exception as e:
+            self._write_chunk({"error": str(e)})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, body: dict) -> None:
+        data = (json.dumps(body, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def serve(HF_API: str, host: str = "127.0.0.1", port: int = 8765, model_id: str = None,
+          backend: str = 'fp16') -> None:
+    '''モデルを一度だけロードして、分析の依頼を待ち続ける
+
+    :param HF_API: str: HuggingFaceのAPIキー
+    :param host: str:
+    :param port: int:
+    :param model_id: str: Noneはバックエンドのディフォルト
+    :param backend: str: llm_backends.BACKENDSのどれか
+    :return: None
+    '''
+
+    from llm_analyzer import LLMAnalyzer
+
+    AnalyzerHandler.analyzer = LLMAnalyzer(HF_API, model_id=model_id, backend=backend)
+    server = ThreadingHTTPServer((host, port), AnalyzerHandler)
+    print(f"分析ワーカーを起動しました: http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def parse_args() -> argparse:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        required=False,
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        required=False,
+    )
+    parser.add_argument(
+        "--model_id",
+        type=str,
+        help="HuggingFaceのモデル名（ない場合はバックエンドのディフォルト）",
+        required=False,
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        default="fp16",
+        help="LLMの推論方法",
+        required=False,
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from api_config import HF_API_KEY
+
+    args = parse_args()
+    serve(HF_API_KEY, args.host, args.port, args.model_id, args.backend)
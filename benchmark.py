@@ -0,0 +1,342 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from llm_backends import BACKENDS
+from metrics import percentile
+
+
+# LLMの分析をしない場合に読み込まれてはいけないモジュール
+HEAVY_MODULES = ['torch', 'transformers', 'langchain', 'langchain_core', 'langchain_huggingface', 'plotly']
+
+STARTUP_CODE = '''
+import json, sys
+import main
+from metrics import peak_rss_mb
+heavy = [m for m in {heavy} if m in sys.modules]
+print(json.dumps({{"heavy": heavy, "max_rss_mb": peak_rss_mb()}}))
+'''
+
+
+def bench_startup(runs:int = 5) -> dict:
+    '''main.pyの読み込み時間とメモリを測る（LLMを使わない場合の起動）
+
+    :param runs: int: 計測回数
+    :return: dict
+    '''
+
+    times, result = [], {}
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", STARTUP_CODE.format(heavy=HEAVY_MODULES)],
+                             cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+        times.append(time.perf_counter() - start)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+
+    return {
+        "runs": runs,
+        "median_seconds": statistics.median(times),
+        "max_seconds": max(times),
+        "max_rss_mb": result["max_rss_mb"],
+        "heavy_modules": result["heavy"],
+    }
+
+
+def load_cached_bs(data_dir:str = './company_finance_data') -> dict:
+    '''保存済みのPrior・CurrentのCSVからバランスシートの表を読み込む
+
+    :param data_dir: str: get_finance_dataの保存先
+    :return: dict: {docID: display_bsの結果}
+    '''
+
+    from display import display_bs
+
+    companies = {}
+    for folder in sorted(Path(data_dir).glob("*/XBRL_TO_CSV")):
+        prior = sorted(folder.glob("prior_*.csv"))
+        current = sorted(folder.glob("current_*.csv"))
+        if prior and current:
+            result = display_bs([[str(prior[0]), str(current[0])]], plot='none')
+            if result:
+                companies[folder.parent.name] = result
+    return companies
+
+
+def bench_analysis(companies:dict, backend:str = 'stub', max_iterations:int = 4) -> dict:
+    '''agent（ReActのエージェント）とfacts（比率を先に計算して一回の生成）の生成量と時間を比べる
+
+    :param companies: dict: {docID: display_bsの結果}
+    :param backend: str: llm_backends.BACKENDSのどれか
+    :param max_iterations: int: agentのツールの呼び出し回数の上限
+    :return: dict: {分析方法: 生成の統計}
+    '''
+
+    import contextlib
+    import io
+    from api_config import HF_API_KEY
+    from llm_analyzer import LLMAnalyzer
+
+    analyzer = LLMAnalyzer(HF_API_KEY, backend=backend, refresh=True)  # 生成キャッシュを使わずに測る
+    modes = {
+        "agent": lambda df_list: analyzer.agent_analyze(df_list, max_iterations=max_iterations),
+        "facts": analyzer.facts_analyze,
+    }
+
+    results = {}
+    for mode, analyze in modes.items():
+        before = analyzer.generator.stats()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # エージェントの途中経過は表示しない
+            for df_list in companies.values():
+                analyze(df_list)
+        wall = time.perf_counter() - start
+        after = analyzer.generator.stats()
+
+        results[mode] = {
+            "companies": len(companies),
+            "calls": after["calls"] - before["calls"],
+            "prompt_tokens": after["prompt_tokens"] - before["prompt_tokens"],
+            "generated_tokens": after["tokens"] - before["tokens"],
+            "wall_seconds_per_company": round(wall / max(1, len(companies)), 3),
+            "peak_rss_mb": after["peak_rss_mb"],
+        }
+    return results
+
+
+def summarize(latencies:list, wall_seconds:float = None, failed:int = 0) -> dict:
+    '''一件ごとの秒数から件数・スループット・p50/p99（ミリ秒）・失敗の割合を計算する
+
+    :param latencies: list: 成功した一件ごとの秒数
+    :param wall_seconds: float: 全体の秒数（並列に実行した場合、Noneは合計）
+    :param failed: int: 再挑戦しても失敗した件数
+    :return: dict
+    '''
+
+    wall = sum(latencies) if wall_seconds is None else wall_seconds
+    total = len(latencies) + failed
+    return {
+        "count": len(latencies),
+        "failed": failed,
+        "error_rate": round(failed / total, 3) if total else 0.0,
+        "per_sec": round(len(latencies) / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def bench_pipeline(docs:int = 50, latency:float = 0.05, jitter:float = 0.02, error_rate:float = 0.0,
+                   max_workers:int = 4, llm:bool = True) -> dict:
+    '''EDINETの代わりのサーバー（edinet_stub.py）を使い、段階ごとの時間を測る
+
+    metadata: documents.jsonの習得と索引への保存、lookup: 会社名からdocIDの検索、
+    download: ZIPのダウンロード（並列）、parse: CSVの読み込みとPrior・Currentの分割、
+    extract: バランスシートの抽出、ratios: 比率の計算、llm: stubのLLMでの分析
+    再挑戦しても失敗した書類は段階ごとに失敗として数え、後の段階では飛ばす。
+
+    :param docs: int: 架空の書類の数
+    :param latency: float: サーバーの応答の遅延（秒）
+    :param jitter: float: 遅延のばらつき（±秒）
+    :param error_rate: float: サーバーが失敗する割合
+    :param max_workers: int: ダウンロードの並列数
+    :param llm: bool: stubのLLMの段階も測るか
+    :return: dict: {段階: {count, failed, error_rate, per_sec, p50_ms, p99_ms}}
+    '''
+
+    import contextlib
+    import io
+    import tempfile
+    import zipfile
+    from concurrent.futures import ThreadPoolExecutor
+    from cache import DocumentCache
+    from cal import cal_ratios, frames_to_bs_table
+    from display import extract_bs
+    from edinet_stub import EdinetStub
+    from meta_store import MetaStore
+    from utils import GetData, is_target_member, read_xbrl_csv, split_frame_with_prior_current
+
+    stub = EdinetStub(latency=latency, jitter=jitter, error_rate=error_rate, synthetic=docs)
+    base_url = stub.start()
+    timings, failures = {}, {}
+
+    def timed(stage, func, *args):
+        '''一件の時間を記録する（失敗した場合は数えてNoneを返す）'''
+
+        timings.setdefault(stage, [])
+        failures.setdefault(stage, 0)
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            failures[stage] += 1
+            return None
+        timings[stage].append(time.perf_counter() - start)
+        return result
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            get_data = GetData("stub", max_workers=max_workers, rate_limit=1000, burst=max_workers,
+                               backoff=0.01, cache=DocumentCache(f"{tmp}/cache"), base_url=base_url)
+            meta_store = MetaStore(f"{tmp}/meta.sqlite3")
+
+            for day in range(1, 6):
+                get_date = f"2025-07-{day:02d}"
+                timed("metadata", lambda d: meta_store.upsert(get_data.create_csv(d), d), get_date)
+
+            def lookup(filer_name):
+                doc_ids = meta_store.find_doc_ids(filer_name)
+                if not doc_ids:
+                    raise LookupError(f"{filer_name}の書類がありません")
+                return doc_ids[0]
+
+            doc_ids = [timed("lookup", lookup, f"ベンチマーク株式会社{i + 1}") for i in range(docs)]
+            doc_ids = [doc_id for doc_id in doc_ids if doc_id is not None]
+            meta_store.close()
+
+            def download(doc_id):
+                url = f"{base_url}/documents/{doc_id}"
+                return timed("download", get_data._request_with_retry, url, {"type": 5, "Subscription-Key": "stub"})
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                contents = list(executor.map(download, doc_ids))
+            download_wall = time.perf_counter() - start
+
+            def parse(content):
+                with zipfile.ZipFile(io.BytesIO(content)) as z:
+                    members = [file for file in z.namelist() if is_target_member(file)]
+                    with z.open(members[-1]) as f:
+                        return list(split_frame_with_prior_current(read_xbrl_csv(f)))
+
+            def extract(doc_id, f):
+                return [df for _, df in extract_bs({doc_id: f})[doc_id]]
+
+            # 前の段階で失敗した書類は飛ばす
+            frames = {doc_id: timed("parse", parse, content)
+                      for doc_id, content in zip(doc_ids, contents) if content is not None}
+            frames = {doc_id: f for doc_id, f in frames.items() if f is not None}
+            tables = {doc_id: timed("extract", extract, doc_id, f) for doc_id, f in frames.items()}
+            tables = {doc_id: df_list for doc_id, df_list in tables.items() if df_list is not None}
+            for df_list in tables.values():
+                timed("ratios", lambda d: cal_ratios(frames_to_bs_table(d)), df_list)
+
+            if llm:
+                from llm_analyzer import LLMAnalyzer
+                analyzer = LLMAnalyzer(None, backend="stub", refresh=True)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for df_list in tables.values():
+                        timed("llm", analyzer.facts_analyze, df_list)
+    finally:
+        stub.stop()
+
+    result = {stage: summarize(latencies, download_wall if stage == "download" else None, failures[stage])
+              for stage, latencies in timings.items()}
+    result["server"] = {"requests": stub.requests, "injected_errors": stub.errors}
+    return result
+
+
+def parse_args() -> argparse:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "target",
+        type=str,
+        choices=["startup", "analysis", "pipeline"],
+        help="計測する対象",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="計測回数",
+        required=False,
+    )
+    parser.add_argument(
+        "--max_seconds",
+        type=float,
+        default=1.0,
+        help="起動時間の上限（超えた場合は終了コード1）",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        default="stub",
+        help="analysisで使うLLMの推論方法",
+        required=False,
+    )
+    parser.add_argument(
+        "--max_iterations",
+        type=int,
+        default=4,
+        help="analysisのagentのツールの呼び出し回数の上限",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--docs",
+        type=int,
+        default=50,
+        help="pipelineで使う架空の書類の数",
+        required=False,
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="pipelineのサーバーの応答の遅延（秒）",
+        required=False,
+    )
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        default=0.0,
+        help="pipelineのサーバーが失敗する割合（0～1）",
+        required=False,
+    )
+    parser.add_argument(
+        "--max_workers",
+        "-mw",
+        type=int,
+        default=4,
+        help="pipelineのダウンロードの並列数",
+        required=False,
+    )
+    parser.add_argument(
+        "--no_llm",
+        action="store_true",
+        help="pipelineでLLMの段階を測らない",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.target == "startup":
+        result = bench_startup(args.runs)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        if result["heavy_modules"]:
+            print(f"起動時に重いモジュールが読み込まれています: {result['heavy_modules']}")
+            sys.exit(1)
+        if result["median_seconds"] > args.max_seconds:
+            print(f"起動時間が上限を超えています: {round(result['median_seconds'], 3)}秒 > {args.max_seconds}秒")
+            sys.exit(1)
+
+    elif args.target == "analysis":
+        companies = load_cached_bs()
+        if not companies:
+            print("company_finance_dataにPriorとCurrentのCSVがありません（main.py --save_csv で保存してください）")
+            sys.exit(1)
+        result = bench_analysis(companies, args.backend, args.max_iterations)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    elif args.target == "pipeline":
+        result = bench_pipeline(args.docs, args.latency, error_rate=args.error_rate,
+                                max_workers=args.max_workers, llm=not args.no_llm)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
@@ -0,0 +1,313 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間のロックを使わない
+    fcntl = None
+
+
+def file_sha256(path: Path) -> str:
+    '''ファイルのSHA-256を計算
+
+    :param path: Path:
+    :return: str
+    '''
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def file_lock(path: Path):
+    '''ファイルロックで他のプロセスと排他する（fcntlの無い環境では何もしない）
+
+    :param path: Path: ロックに使うファイル
+    '''
+
+    with open(path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def evict_lru(entries: dict, max_bytes: Optional[int] = None, max_age_days: Optional[float] = None,
+              keep: tuple = ()) -> list:
+    '''LRUで削除すべきキーを選ぶ
+
+    :param entries: dict: {キー: {"size": int, "last_access": float}}
+    :param max_bytes: int: 合計サイズの上限（Noneは無制限）
+    :param max_age_days: float: 最終アクセスからの日数の上限（Noneは無制限）
+    :param keep: tuple: 削除しないキー
+    :return: list: 削除するキー（古い順）
+    '''
+
+    now = time.time()
+    order = sorted(entries, key=lambda k: entries[k].get("last_access", 0))
+    evict = []
+
+    if max_age_days is not None:
+        limit = now - max_age_days * 86400
+        evict = [k for k in order if k not in keep and entries[k].get("last_access", 0) < limit]
+
+    if max_bytes is not None:
+        total = sum(entries[k].get("size", 0) for k in order if k not in evict)
+        for k in order:
+            if total <= max_bytes:
+                break
+            if k in keep or k in evict:
+                continue
+            evict.append(k)
+            total -= entries[k].get("size", 0)
+
+    return evict
+
+
+class DocumentCache:
+    '''書類管理番号(docID)をキーにしたディスクキャッシュ
+
+    company_finance_data/<docID>/ に展開したCSVと、内容のハッシュで保存したZIPを
+    manifest.json で管理する。展開したファイルが壊れている場合はZIPから修復する。
+    manifest.json を書き換える前にファイルロックを取ってディスクから読み直すため、
+    複数のインスタンスやプロセスで同じフォルダを使っても他の登録を消さない。
+    '''
+
+    def __init__(self, root: str = './company_finance_data', max_bytes: Optional[int] = None,
+                 max_age_days: Optional[float] = None, keep_zip: bool = True) -> None:
+        self.root = Path(root)
+        self.blob_dir = self.root / ".zips"
+        self.manifest_path = self.root / "manifest.json"
+        self.lock_path = self.root / "manifest.lock"
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.keep_zip = keep_zip
+        self.lock = threading.Lock()
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+
+    def _load_manifest(self) -> dict:
+        if not self.manifest_path.exists():
+            return {}
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            print("manifest.jsonが壊れているため作り直します")
+            return {}
+
+
+    @contextmanager
+    def _locked(self):
+        '''スレッドとプロセスの両方でロックし、ディスクの最新のマニフェストを読み直す'''
+
+        with self.lock, file_lock(self.lock_path):
+            self.manifest = self._load_manifest()
+            yield
+
+
+    def _save_manifest(self) -> None:
+        tmp = self.manifest_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.manifest_path)
+
+
+    def doc_dir(self, doc_id: str) -> Path:
+        return self.root / doc_id
+
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.blob_dir / f"{digest}.zip"
+
+
+    def _is_valid(self, doc_id: str, entry: dict) -> bool:
+        '''展開したファイルとPrior/Currentのファイルを検証する'''
+
+        base = self.doc_dir(doc_id)
+        for member, info in entry.get("members", {}).items():
+            path = base / member
+            if not path.exists() or path.stat().st_size != info["size"]:
+                return False
+            if info.get("sha256") and file_sha256(path) != info["sha256"]:
+                return False
+        for path in entry.get("splits", []):
+            if not Path(path).exists() or Path(path).stat().st_size == 0:
+                return False
+        return bool(entry.get("members")) and len(entry.get("splits", [])) == 2
+
+
+    def _adopt(self, doc_id: str) -> Optional[dict]:
+        '''マニフェスト導入前に展開済みのフォルダを登録する'''
+
+        csv_dir = self.doc_dir(doc_id) / "XBRL_TO_CSV"
+        if not csv_dir.exists():
+            return None
+        for path in csv_dir.glob("*.csv"):
+            if path.name.startswith(("prior_", "current_")) or path.stat().st_size == 0:
+                continue
+            prior = csv_dir / f"prior_{path.stem}.csv"
+            current = csv_dir / f"current_{path.stem}.csv"
+            if prior.exists() and current.exists():
+                member = path.relative_to(self.doc_dir(doc_id)).as_posix()
+                return self._make_entry(doc_id, None, [member], [prior, current])
+        return None
+
+
+    def _make_entry(self, doc_id: str, zip_sha256: Optional[str], members: list, splits: list) -> dict:
+        base = self.doc_dir(doc_id)
+        now = time.time()
+        entry = {
+            "docID": doc_id,
+            "zip_sha256": zip_sha256,
+            "members": {m: {"size": (base / m).stat().st_size, "sha256": file_sha256(base / m)} for m in members},
+            "splits": [str(p) for p in splits],
+            "created_at": now,
+            "last_access": now,
+        }
+        entry["size"] = sum(info["size"] for info in entry["members"].values()) \
+                        + sum(Path(p).stat().st_size for p in entry["splits"])
+        if zip_sha256 and self._blob_path(zip_sha256).exists():
+            entry["size"] += self._blob_path(zip_sha256).stat().st_size
+        return entry
+
+
+    def get(self, doc_id: str) -> Optional[list]:
+        '''キャッシュにある場合は[prior_path, current_path]を返す
+
+        :param doc_id: str:
+        :return: list or None
+        '''
+
+        with self._locked():
+            entry = self.manifest.get(doc_id)
+            if entry is None:
+                entry = self._adopt(doc_id)
+                if entry is None:
+                    return None
+                self.manifest[doc_id] = entry
+            elif not entry.get("splits"):
+                # ZIPのみ保存している書類
+                return None
+            elif not self._is_valid(doc_id, entry):
+                print(f"{doc_id}のキャッシュが壊れているため修復します")
+                return None
+
+            entry["last_access"] = time.time()
+            self._save_manifest()
+            return [Path(p) for p in entry["splits"]]
+
+
+    def get_zip(self, doc_id: str) -> Optional[bytes]:
+        '''保存済みのZIPを返す（ハッシュが一致しない場合はNone）
+
+        :param doc_id: str:
+        :return: bytes or None
+        '''
+
+        entry = self.manifest.get(doc_id)
+        if not entry or not entry.get("zip_sha256"):
+            return None
+        path = self._blob_path(entry["zip_sha256"])
+        if not path.exists():
+            return None
+        content = path.read_bytes()
+        if hashlib.sha256(content).hexdigest() != entry["zip_sha256"]:
+            path.unlink()
+            return None
+        return content
+
+
+    def put(self, doc_id: str, content: bytes, members: list, splits: list) -> None:
+        '''ダウンロードしたZIPと展開したファイルを登録する
+
+        :param doc_id: str:
+        :param content: bytes: ZIPの中身
+        :param members: list: 展開したZIPのメンバー名
+        :param splits: list: [prior_path, current_path]
+        :return: None
+        '''
+
+        digest = hashlib.sha256(content).hexdigest()
+        if self.keep_zip:
+            self._write_blob(digest, content)
+
+        with self._locked():
+            self.manifest[doc_id] = self._make_entry(doc_id, digest, members, splits)
+            self._evict(keep=(doc_id,))
+            self._save_manifest()
+
+
+    def put_zip(self, doc_id: str, content: bytes) -> None:
+        '''ディスクに展開せずに読み込んだ書類のZIPだけを登録する
+
+        :param doc_id: str:
+        :param content: bytes: ZIPの中身
+        :return: None
+        '''
+
+        digest = hashlib.sha256(content).hexdigest()
+        if self.keep_zip:
+            self._write_blob(digest, content)
+
+        with self._locked():
+            entry = self.manifest.get(doc_id)
+            if entry is not None and entry.get("splits") and entry.get("zip_sha256") in (None, digest):
+                # 展開済みの書類はそのまま使う
+                entry["zip_sha256"] = digest
+                entry["last_access"] = time.time()
+            elif self.keep_zip:
+                self.manifest[doc_id] = self._make_entry(doc_id, digest, [], [])
+            else:
+                return
+            self._evict(keep=(doc_id,))
+            self._save_manifest()
+
+
+    def _write_blob(self, digest: str, content: bytes) -> None:
+        self.blob_dir.mkdir(exist_ok=True)
+        blob = self._blob_path(digest)
+        if not blob.exists():
+            tmp = blob.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp.write_bytes(content)
+            os.replace(tmp, blob)
+
+
+    def evict(self) -> list:
+        '''設定したサイズと期間を超えた書類を古い順に削除する
+
+        :return: list: 削除した書類管理番号
+        '''
+
+        with self._locked():
+            removed = self._evict()
+            self._save_manifest()
+        return removed
+
+
+    def _evict(self, keep: tuple = ()) -> list:
+        removed = evict_lru(self.manifest, self.max_bytes, self.max_age_days, keep)
+        for doc_id in removed:
+            entry = self.manifest.pop(doc_id)
+            shutil.rmtree(self.doc_dir(doc_id), ignore_errors=True)
+            digest = entry.get("zip_sha256")
+            if digest and all(e.get("zip_sha256") != digest for e in self.manifest.values()):
+                self._blob_path(digest).unlink(missing_ok=True)
+        if removed:
+            print(f"キャッシュから削除しました: {removed}")
+        return removed
@@ -1,39 +1,90 @@
-def cal_results(result_list):
-    df = result_list
+import numpy as np
+import pandas as pd
+from metrics import METRICS
+
+
+CA = 'CurrentAssets(流動資産)'
+NCA = 'NoncurrentAssets(固定資産)'
+CL = 'CurrentLiabilities(流動負債)'
+NCL = 'NoncurrentLiabilities(固定負債)'
+NA = 'NetAssets(純資産)'
+
+
+def safe_div(numerator, denominator) -> np.ndarray:
+    '''0や欠損で割る場合はNaNを返す割り算'''
+
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    out = np.full(np.broadcast(numerator, denominator).shape, np.nan)
+    np.divide(numerator, denominator, out=out, where=(denominator != 0) & ~np.isnan(denominator))
+    return out
+
 
-    na = sum(df[0]['NetAssets(純資産)'])
-    ncl = sum(df[0]['NoncurrentLiabilities(固定負債)'])
-    cl = sum(df[0]['CurrentLiabilities(流動負債)'])
-    nca = sum(df[0]['NoncurrentAssets(固定資産)'])
-    ca = sum(df[0]['CurrentAssets(流動資産)'])
+# 比率のライブラリ（列の計算のみで全ての会社・期をまとめて計算する）
+RATIOS = {
+    'current_ratio': lambda df: safe_div(df[CA], df[CL]) * 100,  # 流動比率：１００％以上が良い
+    'equity_ratio': lambda df: safe_div(df[NA], df[CA] + df[NCA]) * 100,  # 自己資本比率：５０％以上で良い
+    'fixed_ratio': lambda df: safe_div(df[NCA], df[NA]) * 100,  # 固定比率：１００％以下が望ましい（業種による）
+    'de_ratio': lambda df: safe_div(df[CL] + df[NCL], df[NA]),  # 負債資本倍率(D/E)
+    'debt_ratio': lambda df: safe_div(df[CL] + df[NCL], df[CA] + df[NCA]) * 100,  # 負債比率
+}
 
-    total_assets = nca + ca #総資産
-    total_liabilities = ncl + cl #総負債
+PERIOD_ORDER = {'prior': 0, 'current': 1}
 
-    current_ratio = (ca / cl ) * 100  # １００％以上が良い
-    equity_ratio = (na / total_assets) * 100 #　５０％以上で良い
-    fixed_ratio = (nca/na) * 100 #１００％以下が望ましい（業種による）
+PERIOD_LABELS = {'prior': '前期', 'current': '当期'}
 
-    print(f"前期流動比率は{round(current_ratio,2)}%")
-    print(f"前期自己資本比率は{round(equity_ratio,2)}%")
-    print(f"前期固定比率は{round(fixed_ratio,2)}%")
 
+def cal_ratios(bs_df:pd.DataFrame, ratios:list = None, yoy:bool = True,
+               group_columns:list = ('docID', '連結・個別')) -> pd.DataFrame:
+    '''会社×期のバランスシートの表から比率をまとめて計算する
 
-    t_na = sum(df[1]['NetAssets(純資産)'])
-    t_ncl = sum(df[1]['NoncurrentLiabilities(固定負債)'])
-    t_cl = sum(df[1]['CurrentLiabilities(流動負債)'])
-    t_nca = sum(df[1]['NoncurrentAssets(固定資産)'])
-    t_ca = sum(df[1]['CurrentAssets(流動資産)'])
+    :param bs_df: pd.DataFrame: extractor.extract_balance_sheetsの結果（一行が一社の一期）
+    :param ratios: list: 計算する比率の名前（Noneは全て）
+    :param yoy: bool: 前期からの増減（<比率>_yoy）も計算するか
+    :param group_columns: list: 同じ会社を表す列
+    :return: pd.DataFrame: 元の列に比率の列を加えた表
+    '''
 
+    names = list(RATIOS) if ratios is None else list(ratios)
+    result = bs_df.copy()
+    for name in names:
+        result[name] = RATIOS[name](result)
 
-    t_total_assets = t_nca + t_ca
-    t_total_liabilities = t_ncl + t_cl
+    if yoy and 'period' in result.columns:
+        group_columns = [c for c in group_columns if c in result.columns]
+        is_named = result['period'].isin(list(PERIOD_ORDER)).all()
+        order = result['period'].map(PERIOD_ORDER) if is_named else result['period']
+        result = result.assign(_order=order).sort_values(group_columns + ['_order'], kind='stable')
+        grouped = result.groupby(group_columns, sort=False) if group_columns else result
+        deltas = grouped[names].diff()
+        deltas.columns = [f"{name}_yoy" for name in names]
+        result = pd.concat([result, deltas], axis=1).drop(columns='_order').sort_index()
+
+    return result
+
+
+def frames_to_bs_table(result_list:list) -> pd.DataFrame:
+    '''display_bsの表のリストを一行一期の表にする'''
+
+    items = [CA, NCA, CL, NCL, NA]
+    rows = [{item: df[item].sum() for item in items} for df in result_list]
+    table = pd.DataFrame(rows, columns=items)
+    table['period'] = ['prior', 'current'][-len(rows):] if 0 < len(rows) <= 2 else list(range(len(rows)))
+    return table
+
+
+def cal_results(result_list):
+    if not result_list:
+        print("バランスシートがないため比率を計算できません")
+        return frames_to_bs_table([])
 
-    t_current_ratio = (t_ca / t_cl) * 100
-    t_equity_ratio = (t_na / t_total_assets) * 100
-    t_fixed_ratio = (t_nca / t_na) * 100
+    with METRICS.span("ratios"):
+        table = cal_ratios(frames_to_bs_table(result_list), ['current_ratio', 'equity_ratio', 'fixed_ratio'], yoy=False)
 
-    print(f"当期流動比率は{round(t_current_ratio, 2)}%")
-    print(f"当期自己資本比率は{round(t_equity_ratio, 2)}%")
-    print(f"当期固定比率は{round(t_fixed_ratio, 2)}%")
+    for _, row in table.iterrows():
+        label = PERIOD_LABELS.get(row['period'], f"{row['period']}番目の期")
+        print(f"{label}流動比率は{round(row['current_ratio'], 2)}%")
+        print(f"{label}自己資本比率は{round(row['equity_ratio'], 2)}%")
+        print(f"{label}固定比率は{round(row['fixed_ratio'], 2)}%")
 
+    return table
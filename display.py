@@ -1,56 +1,129 @@
-import pandas as pd
-import plotly.express as px
-from typing import Tuple
+import json
+from datetime import datetime
 from pathlib import Path
+from extractor import extract_balance_sheets, select_consolidation, to_bs_frame
+from metrics import METRICS
 
 
-def display_bs(balance_sheet_list:Tuple[Path, Path], individual:bool = True) -> list:
-    data = {"Name": ['Assets(資産)', 'Liabilities(負債)'],
-            'NetAssets(純資産)': [0, 0],
-            'NoncurrentLiabilities(固定負債)': [0, 0],
-            'CurrentLiabilities(流動負債)': [0, 0],
-            'NoncurrentAssets(固定資産)': [0, 0],
-            'CurrentAssets(流動資産)': [0, 0],
-            }
-
-    bs_csv_list = []
-    for balance_sheet in balance_sheet_list:
-        for idx, path in enumerate(balance_sheet):
-            df = pd.DataFrame.from_dict(data)
-
-            temp_df = pd.read_csv(path)
-            temp_df['要素ID_lower'] = temp_df['要素ID'].str.lower()
-
-            temp_val = "個別" if individual else "連結"
-            temp = temp_df[temp_df['連結・個別'] == temp_val]
-            if temp.empty:
-                print(f"{temp_val}が無いため{"個別" if not individual else "連結"}を使用")
-                temp_val = "個別" if not individual else "連結"
-                temp = temp_df[temp_df['連結・個別'] == temp_val]
-            temp_df = temp.copy()
-            del temp
-
-            temp_df_assets = temp_df[temp_df['要素ID_lower'].str.contains("assets")]
-            df.at[0, 'CurrentAssets(流動資産)'] = int(temp_df_assets[temp_df_assets['項目名'] == "流動資産"]['値'].values[0])
-            df.at[0, 'NoncurrentAssets(固定資産)'] = int(temp_df_assets[temp_df_assets['項目名'] == "固定資産"]['値'].values[0])
-
-            try:
-                temp_val = "Prior1YearInstant_NonConsolidatedMember" if idx == 0 else "CurrentYearInstant_NonConsolidatedMember"
-                df.at[1, 'NetAssets(純資産)'] = int(temp_df_assets[(temp_df_assets['項目名'] == "純資産")
-                                                                    & (temp_df_assets['コンテキストID'] == temp_val)]['値'].values[0])
-            except:
-                temp_val = "Prior1YearInstant" if idx == 0 else "CurrentYearInstant"
-                df.at[1, 'NetAssets(純資産)'] = int(temp_df_assets[(temp_df_assets['項目名'] == "純資産")
-                                                                   & (temp_df_assets['コンテキストID'] == temp_val)][
-                                                        '値'].values[0])
-
-            temp_df_liability = temp_df[temp_df['要素ID_lower'].str.contains("liabilities")]
-            df.at[1, 'CurrentLiabilities(流動負債)'] = int(temp_df_liability[temp_df_liability['項目名'] == "流動負債"]['値'].values[0])
-            df.at[1, 'NoncurrentLiabilities(固定負債)'] = int(temp_df_liability[temp_df_liability['項目名'] == "固定負債"]['値'].values[0])
-
-            fig = px.bar(df, x="Name", y=list(data.keys())[1:], title=f"BS {"(前期)" if idx == 0 else "(当期)"} {"個別" if individual else "連結"}")
+PLOT_MODES = ['show', 'html', 'json', 'image', 'none']
+
+
+def extract_bs(balance_sheet_list:list, individual:bool = True) -> dict:
+    '''全ての書類からバランスシートの表を抽出する（グラフは作らない）
+
+    :param balance_sheet_list: dict or list: {docID: [prior, current]} か [prior, current]（DataFrameかCSVのパス）のリスト
+    :param individual: bool: 個別を使うか（無い場合は連結）
+    :return: dict: {docID: [(タイトル, 前期の表), (タイトル, 当期の表)]}（抽出できた書類のみ）
+    '''
+
+    with METRICS.span("extract"):
+        tidy = extract_balance_sheets(balance_sheet_list)
+
+    results = {}
+    for doc_id in tidy['docID'].unique():
+        selected = select_consolidation(tidy, doc_id, individual)
+        if selected is None:
+            print(f"書類{doc_id}からバランスシートを抽出できません")
+            continue
+
+        results[doc_id] = []
+        for _, row in selected.iterrows():
+            period = "(前期)" if row['period'] == 'prior' else "(当期)"
+            results[doc_id].append((f"BS {period} {row['連結・個別']}", to_bs_frame(row)))
+
+    return results
+
+
+def build_bs_figures(titled_frames:list) -> list:
+    '''(タイトル, 表)のリストから棒グラフを作る
+
+    :param titled_frames: list:
+    :return: list: plotlyのFigure
+    '''
+
+    import plotly.express as px  # グラフを作る場合のみ読み込む
+
+    return [px.bar(df, x="Name", y=list(df.columns[1:]), title=title) for title, df in titled_frames]
+
+
+def render_report(figures:list, plot:str = 'show', report_dir:str = './reports', name:str = None) -> list:
+    '''グラフをまとめて出力する
+
+    show: ブラウザで表示、html: 一つのHTML、json: 一つのJSON、
+    image: PNG（kaleidoが無い場合はHTML）、none: 出力しない
+
+    :param figures: list: plotlyのFigure
+    :param plot: str: 出力方法
+    :param report_dir: str: 保存先
+    :param name: str: ファイル名（Noneは日時）
+    :return: list: 保存したファイル
+    '''
+
+    if plot == 'none' or not figures:
+        return []
+    if plot == 'show':
+        for fig in figures:
             fig.show()
+        return []
+
+    Path(report_dir).mkdir(parents=True, exist_ok=True)
+    name = name or f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+    if plot == 'image':
+        try:
+            paths = []
+            for i, fig in enumerate(figures):
+                path = Path(report_dir) / f"{name}_{i}.png"
+                fig.write_image(path)
+                paths.append(path)
+            return paths
+        except (ImportError, ValueError, RuntimeError) as e:
+            print(f"画像を保存できないためHTMLで保存します: {e}")
+            plot = 'html'
+
+    if plot == 'json':
+        path = Path(report_dir) / f"{name}.json"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump([json.loads(fig.to_json()) for fig in figures], f, ensure_ascii=False)
+        return [path]
+
+    path = Path(report_dir) / f"{name}.html"
+    body = "\n".join(fig.to_html(full_html=False, include_plotlyjs=(i == 0)) for i, fig in enumerate(figures))
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"<html><head><meta charset='utf-8'></head><body>\n{body}\n</body></html>")
+    return [path]
+
+
+def display_bs(balance_sheet_list:list, individual:bool = True, plot:str = 'show',
+               report_dir:str = './reports') -> list:
+    '''バランスシートを抽出してグラフを出力する
+
+    全ての書類を extract_balance_sheets で一度に抽出し、全ての書類のグラフを一つのレポートにまとめる。
+    比率の計算のため、最初に抽出できた書類の前期・当期の表を返す。
+    レポートのファイル名は {docID: [prior, current]} で書類が一つの場合は bs_<docID>、それ以外は日時にする。
+
+    :param balance_sheet_list: dict or list: {docID: [prior, current]} か [prior, current]（DataFrameかCSVのパス）のリスト
+    :param individual: bool: 個別を使うか（無い場合は連結）
+    :param plot: str: グラフの出力方法（PLOT_MODES）
+    :param report_dir: str: グラフの保存先
+    :return: list: [前期の表, 当期の表]
+    '''
+
+    results = extract_bs(balance_sheet_list, individual)
+    if not results:
+        print("バランスシートを抽出できる書類がありません")
+        return []
 
-            bs_csv_list.append(df)
+    is_named = isinstance(balance_sheet_list, dict)
+    if plot != 'none':
+        # 複数の書類の場合は、どの書類のグラフか分かるようにタイトルにdocIDを付ける
+        all_frames = [(f"{doc_id} {title}" if len(results) > 1 and is_named else title, df)
+                      for doc_id, titled_frames in results.items() for title, df in titled_frames]
+        # リストの場合のdocIDは番号のため、ファイル名は日時にする
+        name = f"bs_{next(iter(results))}" if is_named and len(results) == 1 else None
+        with METRICS.span("report", plot=plot):
+            paths = render_report(build_bs_figures(all_frames), plot, report_dir, name=name)
+        for path in paths:
+            print(f"グラフを保存しました: {path}")
 
-        return bs_csv_list
\ No newline at end of file
+    return [df for _, df in next(iter(results.values()))]
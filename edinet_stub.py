@@ -0,0 +1,235 @@
+import argparse
+import io
+import json
+import random
+import threading
+import time
+import zipfile
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+
+def load_fixture_documents(data_dir: str = './company_finance_data') -> dict:
+    '''保存済みの書類からtype=5のZIPを作る
+
+    company_finance_data/<docID>/XBRL_TO_CSV/ の元のCSV（prior_・current_で始まらないもの）を
+    EDINETと同じ XBRL_TO_CSV/ の下に入れる。
+
+    :param data_dir: str: get_finance_dataの保存先
+    :return: dict: {docID: ZIPのバイト列}
+    '''
+
+    documents = {}
+    for folder in sorted(Path(data_dir).glob("*/XBRL_TO_CSV")):
+        files = [f for f in folder.glob("*.csv") if not f.name.startswith(("prior_", "current_"))]
+        if not files:
+            continue
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as z:
+            for file in files:
+                z.write(file, f"XBRL_TO_CSV/{file.name}")
+        documents[folder.parent.name] = buffer.getvalue()
+    return documents
+
+
+def load_fixture_listings(csv_folder: str = './company_csv_folder') -> dict:
+    '''保存済みの書類一覧（data_<日付>.csv）を読み込む
+
+    :param csv_folder: str: 書類一覧の保存先
+    :return: dict: {日付: documents.jsonのresults}
+    '''
+
+    listings = {}
+    for path in sorted(Path(csv_folder).glob("data_*.csv")):
+        df = pd.read_csv(path, dtype=str)
+        listings[path.stem[len("data_"):]] = json.loads(df.to_json(orient="records"))
+    return listings
+
+
+class EdinetStub:
+    '''EDINET API(v2)のdocuments.jsonとdocuments/<docID>?type=5を返すローカルのサーバー
+
+    latencyの秒数（±jitter）だけ遅らせて返し、error_rateの割合で500か429を返す。
+    synthetic件数の架空の書類（SBEN0001など）を保存済みの書類の中身で作り、一覧にも加える。
+    '''
+
+    def __init__(self, data_dir: str = './company_finance_data', csv_folder: str = './company_csv_folder',
+                 latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, synthetic: int = 0,
+                 seed: int = 0) -> None:
+        self.documents = load_fixture_documents(data_dir)
+        self.listings = load_fixture_listings(csv_folder)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+        fixtures = list(self.documents.values())
+        self.synthetic_ids = [f"SBEN{i:04d}" for i in range(1, synthetic + 1)] if fixtures else []
+        for i, doc_id in enumerate(self.synthetic_ids):
+            self.documents[doc_id] = fixtures[i % len(fixtures)]
+
+        self.server = None
+        self.thread = None
+
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api/v2"
+
+
+    def listing(self, date: str) -> list:
+        '''日付の書類一覧（保存済みの一覧と架空の書類）'''
+
+        results = list(self.listings.get(date, []))
+        for i, doc_id in enumerate(self.synthetic_ids):
+            results.append({"seqNumber": len(results) + 1, "docID": doc_id, "edinetCode": f"E9{i:04d}",
+                            "filerName": f"ベンチマーク株式会社{i + 1}", "docTypeCode": "120",
+                            "submitDateTime": f"{date} 09:00", "parentDocID": None, "csvFlag": "1"})
+        return results
+
+
+    def inject(self):
+        '''遅延と失敗を入れる（失敗の場合はステータスコード）'''
+
+        with self.lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+                status = self.random.choice([429, 500])
+        if delay:
+            time.sleep(delay)
+        return status if fail else None
+
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        '''別のスレッドでサーバーを起動する
+
+        :param host: str:
+        :param port: int: 0は空いているポート
+        :return: str: GetDataのbase_urlに渡すURL
+        '''
+
+        handler = type("Handler", (EdinetStubHandler,), {"stub": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.base_url
+
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class EdinetStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    stub = None
+
+    def log_message(self, format, *args) -> None:
+        pass  # リクエストごとのログは出さない
+
+    def _send(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, body: dict) -> None:
+        self._send(status, json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8")
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        status = self.stub.inject()
+        if status is not None:
+            self._send_json(status, {"metadata": {"status": str(status), "message": "injected error"}})
+            return
+
+        if url.path == "/api/v2/documents.json":
+            results = self.stub.listing(query.get("date", ""))
+            self._send_json(200, {"metadata": {"status": "200", "message": "OK",
+                                               "resultset": {"count": len(results)}},
+                                  "results": results})
+            return
+
+        if url.path.startswith("/api/v2/documents/"):
+            doc_id = url.path.rsplit("/", 1)[-1]
+            content = self.stub.documents.get(doc_id)
+            if content is None or query.get("type") != "5":
+                self._send_json(404, {"metadata": {"status": "404", "message": "Not Found"}})
+                return
+            self._send(200, content, "application/octet-stream")
+            return
+
+        self._send_json(404, {"metadata": {"status": "404", "message": "Not Found"}})
+
+
+def parse_args() -> argparse:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        required=False,
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8766,
+        required=False,
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="応答を遅らせる秒数",
+        required=False,
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.0,
+        help="遅延のばらつき（±秒）",
+        required=False,
+    )
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        default=0.0,
+        help="500か429を返す割合（0～1）",
+        required=False,
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=0,
+        help="保存済みの書類から作る架空の書類の数",
+        required=False,
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    stub = EdinetStub(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, synthetic=args.synthetic)
+    print(f"EDINETの代わりのサーバーを起動しました: {stub.start(args.host, args.port)}（書類{len(stub.documents)}件）")
+    try:
+        stub.thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+
+# 要素IDとバランスシートの項目の対応表
+BS_ELEMENTS = {
+    'jppfs_cor:CurrentAssets': 'CurrentAssets(流動資産)',
+    'jppfs_cor:NoncurrentAssets': 'NoncurrentAssets(固定資産)',
+    'jppfs_cor:CurrentLiabilities': 'CurrentLiabilities(流動負債)',
+    'jppfs_cor:NoncurrentLiabilities': 'NoncurrentLiabilities(固定負債)',
+    'jppfs_cor:NetAssets': 'NetAssets(純資産)',
+}
+
+# コンテキストIDと期の対応表（個別のみの会社は_NonConsolidatedMemberが付かない）
+BS_CONTEXTS = {
+    'Prior1YearInstant': 'prior',
+    'Prior1YearInstant_NonConsolidatedMember': 'prior',
+    'CurrentYearInstant': 'current',
+    'CurrentYearInstant_NonConsolidatedMember': 'current',
+}
+
+BS_ITEMS = list(BS_ELEMENTS.values())
+PERIODS = ['prior', 'current']
+
+
+def _map_codes(column: pd.Series, table: dict) -> pd.Series:
+    '''カテゴリの場合はカテゴリごとに一度だけ対応表を引く'''
+
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        lookup = np.array([table.get(c) for c in column.cat.categories] + [None], dtype=object)
+        return pd.Series(lookup[column.cat.codes.to_numpy()], index=column.index)
+    return column.map(table)
+
+
+def extract_balance_sheets(documents) -> pd.DataFrame:
+    '''複数の書類からバランスシートの項目をまとめて抽出する
+
+    要素IDとコンテキストIDを対応表で一度だけ変換し、一回のgroupbyで
+    書類・連結/個別・期ごとの項目を横に並べる。
+
+    :param documents: dict: {docID: [prior_df, current_df]}（listの場合は番号がdocIDになる）
+    :return: pd.DataFrame: docID・連結・個別・period・各項目の列
+    '''
+
+    if not isinstance(documents, dict):
+        documents = dict(enumerate(documents))
+
+    frames, keys = [], []
+    for doc_id, balance_sheet in documents.items():
+        for frame in balance_sheet:
+            if isinstance(frame, pd.DataFrame):
+                frames.append(frame)
+            else:
+                frames.append(pd.read_csv(frame, usecols=['要素ID', 'コンテキストID', '連結・個別', '値']))
+            keys.append(doc_id)
+
+    columns = ['docID', '連結・個別', 'period'] + BS_ITEMS
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.concat(frames, keys=range(len(frames)), names=['frame', None])
+    df = df[['要素ID', 'コンテキストID', '連結・個別', '値']].reset_index(level='frame')
+    df['item'] = _map_codes(df['要素ID'], BS_ELEMENTS)
+    df['period'] = _map_codes(df['コンテキストID'], BS_CONTEXTS)
+    df = df[df['item'].notna() & df['period'].notna()]
+
+    df = df.assign(**{
+        'docID': np.array(keys, dtype=object)[df['frame'].to_numpy()],
+        '連結・個別': df['連結・個別'].astype(str),
+        '値': pd.to_numeric(df['値'], errors='coerce'),
+    })
+
+    tidy = (df.groupby(['docID', '連結・個別', 'period', 'item'], sort=False)['値'].first()
+              .unstack('item')
+              .reindex(columns=BS_ITEMS)
+              .reset_index())
+    tidy.columns.name = None
+
+    # 書類の順番と前期→当期の順に並べる
+    doc_order = {doc_id: i for i, doc_id in enumerate(documents)}
+    tidy = (tidy.assign(_doc=tidy['docID'].map(doc_order), _period=tidy['period'].map(PERIODS.index))
+                .sort_values(['_doc', '連結・個別', '_period'])
+                .reset_index(drop=True))
+    return tidy[columns]
+
+
+def select_consolidation(tidy: pd.DataFrame, doc_id, individual: bool = True) -> Optional[pd.DataFrame]:
+    '''一つの書類の個別か連結のデータを選ぶ（無い場合はもう一方を使う）
+
+    :param tidy: pd.DataFrame: extract_balance_sheetsの結果
+    :param doc_id: 書類管理番号
+    :param individual: bool: 個別を使うか
+    :return: pd.DataFrame: 前期・当期の行（どちらも無い場合はNone）
+    '''
+
+    doc = tidy[tidy['docID'] == doc_id]
+    temp_val = "個別" if individual else "連結"
+    selected = doc[doc['連結・個別'] == temp_val]
+    if selected.empty:
+        other = "連結" if individual else "個別"
+        print(f"{temp_val}が無いため{other}を使用")
+        selected = doc[doc['連結・個別'] == other]
+    if selected.empty:
+        return None
+    return selected.reset_index(drop=True)
+
+
+def to_bs_frame(row: pd.Series) -> pd.DataFrame:
+    '''抽出した一期分の項目を資産・負債の2行の表にする（display_bsの形式）
+
+    :param row: pd.Series: extract_balance_sheetsの一行
+    :return: pd.DataFrame
+    '''
+
+    values = {item: (0 if pd.isna(row[item]) else int(row[item])) for item in BS_ITEMS}
+    return pd.DataFrame.from_dict({
+        "Name": ['Assets(資産)', 'Liabilities(負債)'],
+        'NetAssets(純資産)': [0, values['NetAssets(純資産)']],
+        'NoncurrentLiabilities(固定負債)': [0, values['NoncurrentLiabilities(固定負債)']],
+        'CurrentLiabilities(流動負債)': [0, values['CurrentLiabilities(流動負債)']],
+        'NoncurrentAssets(固定資産)': [values['NoncurrentAssets(固定資産)'], 0],
+        'CurrentAssets(流動資産)': [values['CurrentAssets(流動資産)'], 0],
+    })
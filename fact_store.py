@@ -0,0 +1,125 @@
+import shutil
+import pandas as pd
+from pathlib import Path
+from typing import Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrowがない場合はFactStoreを使えない
+    pa = None
+
+
+# 文字列の列は辞書型（カテゴリ）で保存する
+FACT_STRING_COLUMNS = ['period', '要素ID', '項目名', 'コンテキストID', '連結・個別']
+
+
+class FactStore:
+    '''XBRLのデータ（ファクト）を書類管理番号(docID)ごとにParquetで保存する
+
+    company_fact_store/docID=<docID>/facts.parquet に分けて保存し、
+    docID・コンテキストID・要素IDの条件で必要な部分だけを読み込む。
+    '''
+
+    def __init__(self, root: str = './company_fact_store', row_group_size: int = 256) -> None:
+        if pa is None:
+            raise ImportError("FactStoreにはpyarrowが必要です: pip install pyarrow")
+
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.row_group_size = row_group_size
+        self.schema = pa.schema(
+            [pa.field(c, pa.dictionary(pa.int32(), pa.string())) for c in FACT_STRING_COLUMNS]
+            + [pa.field('値', pa.float64())]
+        )
+
+
+    def _partition(self, doc_id: str) -> Path:
+        return self.root / f"docID={doc_id}"
+
+
+    def has(self, doc_id: str) -> bool:
+        return (self._partition(doc_id) / "facts.parquet").exists()
+
+
+    def write(self, doc_id: str, prior_df: pd.DataFrame, current_df: pd.DataFrame) -> Path:
+        '''PriorとCurrentのデータを正規化して保存する
+
+        :param doc_id: str: 書類管理番号
+        :param prior_df: pd.DataFrame:
+        :param current_df: pd.DataFrame:
+        :return: Path: 保存したファイル
+        '''
+
+        df = pd.concat([prior_df.assign(period='prior'), current_df.assign(period='current')], ignore_index=True)
+        df = df[FACT_STRING_COLUMNS + ['値']].copy()
+        df['値'] = pd.to_numeric(df['値'], errors='coerce')
+        # 要素IDで並べて、行グループの統計で読み飛ばせるようにする
+        df = df.sort_values(['要素ID', 'コンテキストID'], kind='stable')
+
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        partition = self._partition(doc_id)
+        tmp = self.root / f".tmp_{doc_id}"  # "."で始まるフォルダは読み込み時に無視される
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        pq.write_table(table, tmp / "facts.parquet", row_group_size=self.row_group_size)
+        shutil.rmtree(partition, ignore_errors=True)
+        tmp.rename(partition)
+        return partition / "facts.parquet"
+
+
+    def load(self, doc_ids: list = None, context_ids: list = None, element_ids: list = None,
+             consolidated: str = None, period: str = None, columns: list = None) -> pd.DataFrame:
+        '''条件に合うファクトだけを読み込む
+
+        :param doc_ids: list: 書類管理番号
+        :param context_ids: list: コンテキストID
+        :param element_ids: list: 要素ID
+        :param consolidated: str: "連結"または"個別"
+        :param period: str: "prior"または"current"
+        :param columns: list: 読み込む列（Noneは全ての列）
+        :return: pd.DataFrame: docIDの列を含む
+        '''
+
+        if not any(self.root.glob("docID=*/facts.parquet")):
+            return pd.DataFrame(columns=['docID'] + FACT_STRING_COLUMNS + ['値'])
+
+        dataset = ds.dataset(
+            self.root, format="parquet", schema=self.schema.append(pa.field('docID', pa.string())),
+            partitioning=ds.partitioning(pa.schema([('docID', pa.string())]), flavor="hive"),
+            exclude_invalid_files=True,
+        )
+
+        conditions = []
+        if doc_ids is not None:
+            conditions.append(ds.field('docID').isin(list(doc_ids)))
+        if context_ids is not None:
+            conditions.append(ds.field('コンテキストID').isin(list(context_ids)))
+        if element_ids is not None:
+            conditions.append(ds.field('要素ID').isin(list(element_ids)))
+        if consolidated is not None:
+            conditions.append(ds.field('連結・個別') == consolidated)
+        if period is not None:
+            conditions.append(ds.field('period') == period)
+
+        expression = None
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+
+        if columns is not None and 'docID' not in columns:
+            columns = ['docID'] + list(columns)
+        return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+    def load_frames(self, doc_id: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        '''GetData.get_finance_framesと同じ形のPriorとCurrentのデータを返す
+
+        :param doc_id: str:
+        :return: Tuple[pd.DataFrame, pd.DataFrame]
+        '''
+
+        df = self.load(doc_ids=[doc_id]).drop(columns=['docID'])
+        prior_df = df[df['period'] == 'prior'].drop(columns=['period']).reset_index(drop=True)
+        current_df = df[df['period'] == 'current'].drop(columns=['period']).reset_index(drop=True)
+        return prior_df, current_df
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+from cache import evict_lru, file_lock
+
+
+def generation_key(**parts) -> str:
+    '''モデル・生成の設定・プロンプト・データからキャッシュのキーを作る
+
+    :param parts: JSONにできる値
+    :return: str: SHA-256
+    '''
+
+    text = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    '''LLMの分析結果のディスクキャッシュ
+
+    generation_cache/<キー>.json に最終回答と途中経過を保存し、manifest.json の
+    サイズと最終アクセスでLRUの削除を行う（cache.evict_lru）。
+    DocumentCacheと同じく、manifest.json を書き換える前にファイルロックを取ってディスクから読み直す。
+    '''
+
+    def __init__(self, root: str = './generation_cache', max_bytes: Optional[int] = None,
+                 max_age_days: Optional[float] = None) -> None:
+        self.root = Path(root)
+        self.manifest_path = self.root / "manifest.json"
+        self.lock_path = self.root / "manifest.lock"
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.lock = threading.Lock()
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+
+    def _load_manifest(self) -> dict:
+        if not self.manifest_path.exists():
+            return {}
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            print(f"生成キャッシュのmanifestを読み込めないため作り直します: {self.manifest_path}")
+            return {}
+
+
+    @contextmanager
+    def _locked(self):
+        '''スレッドとプロセスの両方でロックし、ディスクの最新のマニフェストを読み直す'''
+
+        with self.lock, file_lock(self.lock_path):
+            self.manifest = self._load_manifest()
+            yield
+
+
+    def _save_manifest(self) -> None:
+        tmp = self.manifest_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False)
+        os.replace(tmp, self.manifest_path)
+
+
+    def get(self, key: str) -> Optional[dict]:
+        '''キャッシュの結果を返す（無い場合はNone）
+
+        :param key: str: generation_keyの結果
+        :return: dict: {"output": str, "intermediate_steps": list, "created": float}
+        '''
+
+        path = self.root / f"{key}.json"
+        with self._locked():
+            if not path.exists():
+                return None
+            try:
+                with open(path, encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return None
+            # manifestに無い結果（以前の版で登録が消えたもの）は登録し直し、削除の対象にする
+            self.manifest.setdefault(key, {"size": path.stat().st_size})["last_access"] = time.time()
+            self._save_manifest()
+        return entry
+
+
+    def put(self, key: str, output: str, intermediate_steps: list = None, **meta) -> None:
+        '''結果を保存し、上限を超えた古い結果を削除する
+
+        :param key: str: generation_keyの結果
+        :param output: str: 最終回答
+        :param intermediate_steps: list: エージェントの途中経過
+        :param meta: 一緒に保存する情報（model_idなど）
+        :return: None
+        '''
+
+        entry = {"output": output, "intermediate_steps": intermediate_steps or [], "created": time.time(), **meta}
+        path = self.root / f"{key}.json"
+        data = json.dumps(entry, ensure_ascii=False, default=str).encode("utf-8")
+
+        with self._locked():
+            tmp = path.with_suffix(".tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+            self.manifest[key] = {"size": len(data), "last_access": time.time()}
+
+            for old in evict_lru(self.manifest, self.max_bytes, self.max_age_days, keep=(key,)):
+                (self.root / f"{old}.json").unlink(missing_ok=True)
+                del self.manifest[old]
+            self._save_manifest()
@@ -1,68 +1,124 @@
-import torch
-import transformers
-from transformers import (
-    pipeline,
-    AutoTokenizer,
-    AutoModelForCausalLM,
-)
+import re
+import threading
+from typing import Iterator, Tuple
+from llm_backends import load_backend, DEFAULT_MODEL_ID, SMALL_MODEL_ID
+from cal import cal_ratios, frames_to_bs_table, CA, NCA, CL, NCL, NA
+from news import NewsClient, DuckDuckGoNewsBackend
+from generation_cache import GenerationCache, generation_key
+from metrics import METRICS
 from langchain.chains import LLMChain
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_huggingface import HuggingFacePipeline
 from langchain.agents import AgentExecutor, create_react_agent
-from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
-from langchain_community.tools import DuckDuckGoSearchResults
 from langchain_core.tools import Tool
 
 
+# ニュース検索のキャッシュの保存先
+NEWS_CACHE_PATH = './news_cache/news.json'
+
+# モデル・トークナイザー・パイプラインのキャッシュ（プロセス内で一度だけロードする）
+_PIPELINE_CACHE = {}
+_PIPELINE_LOCK = threading.Lock()
+_GENERATION_LOCK = threading.Lock()  # 共有するトークナイザーの設定を変える間のロック
+
+
+def load_pipeline(model_id: str, HF_API: str, backend: str = 'fp16') -> tuple:
+    """model_idとバックエンドごとにモデル・トークナイザー・パイプラインをロードする（二回目以降はキャッシュ）
+
+    :param model_id: str: HuggingFaceのモデル名
+    :param HF_API: str: HuggingFaceのAPIキー
+    :param backend: str: llm_backends.BACKENDSのどれか（モデルの型・量子化）
+    :return: tuple: (model, tokenizer, generator)
+    """
+
+    key = (model_id, backend)
+    with _PIPELINE_LOCK:
+        if key not in _PIPELINE_CACHE:
+            _PIPELINE_CACHE[key] = load_backend(backend, model_id, HF_API)
+        return _PIPELINE_CACHE[key]
+
+
+# 複数の会社をまとめて分析する場合のプロンプト（ツールは使わない）
+BATCH_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """
+    You are a highly knowledgeable finance chatbot. Your purpose is to provide accurate, insightful,
+    and actionable financial advice to users, tailored to their specific needs and contexts.
+    Answer with a short analysis of the company's financial position.
+    """),
+
+    ("user", "Analyze this company's balance sheet: {data}\nFinal Answer:")
+])
+
+
+# 計算済みの比率を渡して一回の生成で分析する場合のプロンプト
+FACTS_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """
+    You are a highly knowledgeable finance chatbot. The figures below are already calculated;
+    do not recalculate them. Give a short analysis of liquidity, leverage and the change from the prior year.
+    """),
+
+    ("user", "Balance sheet facts:\n{facts}\nFinal Answer:")
+])
+
+
 class LLMAnalyzer:
-    def __init__(self, HF_API: str, model_id: str = 'tarun7r/Finance-Llama-8B') -> None:
+    def __init__(self, HF_API: str, model_id: str = None, backend: str = 'fp16', news: NewsClient = None,
+                 generation_cache: GenerationCache = None, refresh: bool = False) -> None:
         self.api = HF_API
+        self.backend = backend
+        if model_id is None:
+            model_id = {'small': SMALL_MODEL_ID, 'stub': 'stub'}.get(backend, DEFAULT_MODEL_ID)
         self.model_id = model_id
 
-        # モデルのロード
-        self.model_config = transformers.AutoConfig.from_pretrained(
-            model_id,
-            token=self.api
-        )
+        # 同じプロセスで作成済みの場合はロードしない
+        self.model, self.tokenizer, self.generator = load_pipeline(model_id, HF_API, backend)
+        self.model_config = self.model.config if self.model is not None else None
 
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_id,
-            trust_remote_code=True,
-            torch_dtype=torch.float16,
-            config=self.model_config,
-            device_map='auto',
-            token=self.api,
-            low_cpu_mem_usage=True, # if true, create multiple processes or threads to handle loading and offloading -> slow
-            weights_only=True
-        )
+        self.llm = HuggingFacePipeline(pipeline=self.generator, model_id=self.model_id)
 
-        # Set device
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            model_id,  # モデル名
-            add_eos_token=True,  # データへのEOSの追加を指示
-            trust_remote_code=True,
-            token=self.api,
-        )
-        self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.tokenizer.padding_side = "right"
-
-        self.generator = pipeline(
-            "text-generation",
-            model=self.model,
-            tokenizer=self.tokenizer,
-            max_new_tokens=512,
-            temperature=0.5,
-        )
+        # news_searchのツールが使うニュース検索（ディフォルトはDuckDuckGo、結果はキャッシュする）
+        self.news = news if news is not None else NewsClient(DuckDuckGoNewsBackend(), cache_path=NEWS_CACHE_PATH)
+
+        # 同じモデル・設定・プロンプト・データの分析結果を再利用する（refreshの場合は生成し直して上書き）
+        self.generation_cache = generation_cache if generation_cache is not None else GenerationCache()
+        self.refresh = refresh
+
+
+    def _generation_params(self, **extra) -> dict:
+        '''キャッシュのキーにする生成の設定（パイプラインの設定と引数）'''
+
+        params = dict(getattr(self.generator, "_forward_params", None) or {})
+        return {"backend": self.backend, **params, **extra}
 
-        self.llm = HuggingFacePipeline(pipeline=self.generator)
 
+    def _cached(self, key: str):
+        '''キャッシュの結果を返す（refreshの場合は使わない）'''
 
-    def agent_analyze(self, df_list: list) -> None:
+        if self.refresh:
+            return None
+        cached = self.generation_cache.get(key)
+        METRICS.count("generation_cache_hits" if cached is not None else "generation_cache_misses")
+        return cached
+
+
+    def agent_analyze(self, df_list: list, max_iterations: int = 4) -> str:
         def search_web_news(query: str) -> str:
             """Performs a DuckDuckGo news search for the given query in Japanese, daily results, max 2."""
-            wrapper = DuckDuckGoSearchAPIWrapper(region="jp-jp", time="d", max_results=2)
-            engine = DuckDuckGoSearchResults(api_wrapper=wrapper, backend="news")
-            return engine.invoke(f"{query}")
+            return self.news.search(query)
+
+        def calculate_debt_to_equity_ratio_from_text(tool_input: str) -> str:
+            """Toolは一つの文字列を渡すため、'total_debt: X, total_equity: Y'から数字を取り出す"""
+            # 3,530,663,000,000 のような桁区切りのカンマを消してから数字を取り出す
+            text = re.sub(r"(?<=\d),(?=\d)", "", tool_input)
+            number = r"(-?\d+(?:\.\d+)?)"
+            debt = re.search(rf"total_debt\W*?{number}", text, re.IGNORECASE)
+            equity = re.search(rf"total_equity\W*?{number}", text, re.IGNORECASE)
+            if debt and equity:
+                return calculate_debt_to_equity_ratio(float(debt.group(1)), float(equity.group(1)))
+            values = re.findall(number, text)
+            if len(values) < 2:
+                return "Error: Input should be 'total_debt: <number>, total_equity: <number>'."
+            return calculate_debt_to_equity_ratio(float(values[0]), float(values[1]))
 
         def calculate_debt_to_equity_ratio(total_debt: float, total_equity: float) -> str:
             """
@@ -87,7 +143,7 @@ class LLMAnalyzer:
 
         tool_debt_to_equity_calculator = Tool(
             name="debt_to_equity_calculator",
-            func=calculate_debt_to_equity_ratio,
+            func=calculate_debt_to_equity_ratio_from_text,
             description="Tool to calculate the Debt-to-Equity (D/E) ratio."
                         " Useful for assessing a company's financial leverage."
                         " Input should be 'total_debt' (float) and 'total_equity' (float). Returns the D/E ratio."
@@ -124,19 +180,155 @@ class LLMAnalyzer:
             agent=agent,
             tools=tools,
             verbose=True,  # Keep verbose=True to ensure intermediate steps are printed to stdout
-            handle_parsing_errors=True
+            handle_parsing_errors=True,
+            max_iterations=max_iterations,  # ツールの呼び出し回数の上限
+            stream_runnable=False,  # 一回の生成ごとにパイプラインを呼び、トークン数を数える
+            return_intermediate_steps=True,
         )
 
         data = self.get_data_from_csv(df_list)
 
+        key = generation_key(mode="agent", model_id=self.model_id,
+                             params=self._generation_params(max_iterations=max_iterations),
+                             template=prompt_template.pretty_repr(), tools=[t.description for t in tools], data=data)
+        cached = self._cached(key)
+        if cached is not None:
+            print("\n--- Final Answer (cached) ---")
+            print(cached['output'])
+            print("\n" + "=" * 80 + "\n")
+            return cached['output']
+
         print("\n--- Agent's Reasoning Process ---")
 
-        result = agent_executor.invoke({"data": data})
+        with METRICS.span("llm", mode="agent"):
+            result = agent_executor.invoke({"data": data})
+        steps = [{"tool": action.tool, "tool_input": action.tool_input, "log": action.log, "observation": observation}
+                 for action, observation in result.get("intermediate_steps", [])]
+        self.generation_cache.put(key, result['output'], steps, mode="agent", model_id=self.model_id)
 
         print("\n--- Final Answer ---")
         print(result['output'])
         print("\n" + "=" * 80 + "\n")
 
+        return result['output']
+
+
+    def facts_analyze(self, df_list: list, max_new_tokens: int = 256) -> str:
+        """比率をPythonで計算してからプロンプトに入れ、一回の生成で分析する（ReActのループを使わない）
+
+        :param df_list: list: display_bsの結果
+        :param max_new_tokens: int: 生成するトークン数の上限
+        :return: str: 分析結果
+        """
+
+        if not df_list:
+            print("バランスシートがありません")
+            return ""
+
+        facts = self.get_facts_from_csv(df_list)
+        key = generation_key(mode="facts", model_id=self.model_id,
+                             params=self._generation_params(max_new_tokens=max_new_tokens),
+                             template=FACTS_PROMPT.pretty_repr(), data=facts)
+        cached = self._cached(key)
+        if cached is not None:
+            output = cached["output"]
+        else:
+            print("\n--- Analyzing Precomputed Facts ---")
+            prompt = FACTS_PROMPT.format(facts=facts)
+            with METRICS.span("llm", mode="facts"):
+                output = self.generator(prompt, return_full_text=False, max_new_tokens=max_new_tokens)[0]["generated_text"]
+            output = output.split("Final Answer:")[-1].strip()
+            self.generation_cache.put(key, output, mode="facts", model_id=self.model_id)
+
+        print("\n--- Final Answer ---")
+        print(output)
+        print("\n" + "=" * 80 + "\n")
+
+        return output
+
+
+    def get_facts_from_csv(self, df_list: list) -> str:
+        """バランスシートの数字と比率を短い文字列にする
+
+        :param df_list: list: display_bsの結果（前期・当期）
+        :return: str
+        """
+
+        table = cal_ratios(frames_to_bs_table(df_list))
+        lines = []
+        for _, row in table.iterrows():
+            lines.append(
+                f"{row['period'].capitalize()}: CurrentAssets {row[CA]:.0f}, NoncurrentAssets {row[NCA]:.0f}, "
+                f"CurrentLiabilities {row[CL]:.0f}, NoncurrentLiabilities {row[NCL]:.0f}, NetAssets {row[NA]:.0f}; "
+                f"current_ratio {row['current_ratio']:.1f}%, equity_ratio {row['equity_ratio']:.1f}%, "
+                f"fixed_ratio {row['fixed_ratio']:.1f}%, debt_to_equity {row['de_ratio']:.2f}, "
+                f"debt_ratio {row['debt_ratio']:.1f}%"
+            )
+        if len(table) > 1:
+            last = table.iloc[-1]
+            lines.append(
+                f"Change from prior: current_ratio {last['current_ratio_yoy']:+.1f}pt, "
+                f"equity_ratio {last['equity_ratio_yoy']:+.1f}pt, fixed_ratio {last['fixed_ratio_yoy']:+.1f}pt, "
+                f"debt_to_equity {last['de_ratio_yoy']:+.2f}"
+            )
+        return "\n".join(lines)
+
+
+    def report_stats(self) -> dict:
+        """生成したトークン数・速度(tokens/sec)・最大メモリを表示する
+
+        :return: dict
+        """
+
+        stats = {"backend": self.backend, "model_id": self.model_id, **self.generator.stats()}
+        print(f"[{self.backend}] {stats['tokens']} tokens / {stats['seconds']}s "
+              f"= {stats['tokens_per_sec']} tokens/sec, peak RSS {stats['peak_rss_mb']} MB")
+        return stats
+
+
+    def batch_analyze(self, companies: dict, batch_size: int = 8) -> Iterator[Tuple[str, str]]:
+        """複数の会社のバランスシートをまとめて生成し、終わったバッチから順に結果を返す
+
+        プロンプトのトークン数で並べ替えてからバッチにし、パディングを少なくする。
+        生成キャッシュにある会社は最初に返す。
+
+        :param companies: dict: {会社名かdocID: display_bsの結果}
+        :param batch_size: int: 一度に生成する会社の数
+        :return: Iterator[Tuple[str, str]]: (会社名かdocID, 分析結果)
+        """
+
+        prompts, keys = {}, {}
+        for name, df_list in companies.items():
+            data = self.get_data_from_csv(df_list)
+            keys[name] = generation_key(mode="batch", model_id=self.model_id, params=self._generation_params(),
+                                        template=BATCH_PROMPT.pretty_repr(), data=data)
+            cached = self._cached(keys[name])
+            if cached is not None:
+                # 前回と同じ会社・設定は生成しない（修正前に保存した結果は答えの部分だけにする）
+                yield name, cached["output"].split("Final Answer:")[-1].strip()
+            else:
+                prompts[name] = BATCH_PROMPT.format(data=data)
+
+        lengths = {name: len(self.tokenizer(prompt)["input_ids"]) for name, prompt in prompts.items()}
+        order = sorted(prompts, key=lengths.get)
+
+        for start in range(0, len(order), batch_size):
+            names = order[start:start + batch_size]
+            with _GENERATION_LOCK:
+                # デコーダーのみのモデルはまとめて生成する場合に左側をパディングする
+                padding_side = self.tokenizer.padding_side
+                self.tokenizer.padding_side = "left"
+                try:
+                    outputs = self.generator([prompts[name] for name in names], batch_size=len(names),
+                                             return_full_text=False)
+                finally:
+                    self.tokenizer.padding_side = padding_side
+
+            for name, output in zip(names, outputs):
+                text = output[0]["generated_text"].split("Final Answer:")[-1].strip()
+                self.generation_cache.put(keys[name], text, mode="batch", model_id=self.model_id)
+                yield name, text
+
 
     def get_data_from_csv(self, df_list: list) -> str:
         if len(df_list) == 1:
@@ -0,0 +1,195 @@
+import re
+import time
+from metrics import METRICS, peak_rss_mb
+
+
+BACKENDS = ['fp16', 'int8', 'int4', 'small', 'stub']
+
+# バックエンドごとのディフォルトのモデル
+DEFAULT_MODEL_ID = 'tarun7r/Finance-Llama-8B'
+SMALL_MODEL_ID = 'Qwen/Qwen2.5-0.5B-Instruct'
+
+
+class MeteredPipeline:
+    '''text-generationのパイプラインを包み、生成したトークン数と時間を数える
+
+    HuggingFacePipelineからは元のパイプラインと同じように使える。
+    '''
+
+    def __init__(self, generator, tokenizer) -> None:
+        self.generator = generator
+        self.tokenizer = tokenizer
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.generation_seconds = 0.0
+        self.calls = 0
+
+    def __getattr__(self, name):
+        if name == "generator":
+            raise AttributeError(name)
+        return getattr(self.generator, name)
+
+    def __call__(self, prompts, *args, **kwargs):
+        start = time.perf_counter()
+        outputs = self.generator(prompts, *args, **kwargs)
+        self.generation_seconds += time.perf_counter() - start
+        self.calls += 1
+
+        prompt_list = [prompts] if isinstance(prompts, str) else list(prompts)
+        output_list = [outputs] if isinstance(prompts, str) else outputs
+        prompt_tokens = generated_tokens = 0
+        for prompt, output in zip(prompt_list, output_list):
+            prompt_tokens += len(self.tokenizer(prompt)["input_ids"])
+            for candidate in (output if isinstance(output, list) else [output]):
+                text = candidate.get("generated_text", "")
+                if text.startswith(prompt):
+                    text = text[len(prompt):]
+                generated_tokens += len(self.tokenizer(text)["input_ids"])
+        self.prompt_tokens += prompt_tokens
+        self.generated_tokens += generated_tokens
+        METRICS.count("llm_prompt_tokens", prompt_tokens)
+        METRICS.count("llm_tokens_generated", generated_tokens)
+        METRICS.record("generation", time.perf_counter() - start)
+        return outputs
+
+    def stats(self) -> dict:
+        '''生成の速度とメモリ
+
+        :return: dict: calls, prompt_tokens, tokens, seconds, tokens_per_sec, peak_rss_mb
+        '''
+
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "tokens": self.generated_tokens,
+            "seconds": round(self.generation_seconds, 3),
+            "tokens_per_sec": round(self.generated_tokens / self.generation_seconds, 2) if self.generation_seconds else 0.0,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+
+
+class StubTokenizer:
+    '''空白で区切る決定的なトークナイザー（テスト用）'''
+
+    eos_token = "</s>"
+    pad_token = "</s>"
+    padding_side = "right"
+
+    def __call__(self, text: str) -> dict:
+        return {"input_ids": list(range(len(text.split())))}
+
+
+class StubPipeline:
+    '''モデルを読み込まずに決定的な回答を返すtext-generation（テスト用）
+
+    プロンプトのバランスシートの数字から負債資本倍率を計算し、ReActの形式で最終回答を返す。
+    '''
+
+    task = "text-generation"
+
+    def __init__(self) -> None:
+        self.tokenizer = StubTokenizer()
+
+    def _answer(self, prompt: str) -> str:
+        def last(name: str) -> float:
+            values = re.findall(rf"{name}:? (-?\d+(?:\.\d+)?)", prompt)
+            return float(values[-1]) if values else 0.0
+
+        debt = last("CurrentLiabilities") + last("NoncurrentLiabilities")
+        equity = last("NetAssets")
+        ratio = f"{debt / equity:.2f}" if equity else "n/a"
+        return ("Thought: I can answer from the balance sheet.\n"
+                f"Final Answer: Total liabilities are {int(debt)} and net assets are {int(equity)}, "
+                f"so the Debt-to-Equity ratio is {ratio}.")
+
+    def __call__(self, prompts, **kwargs):
+        if isinstance(prompts, str):
+            return [{"generated_text": self._answer(prompts)}]
+        return [[{"generated_text": self._answer(prompt)}] for prompt in prompts]
+
+
+def load_backend(backend: str, model_id: str, HF_API: str) -> tuple:
+    '''バックエンドに合わせてモデル・トークナイザー・パイプラインをロードする
+
+    fp16: float16（device_map='auto'）、int8/int4: 読み込みながら重みを量子化
+    （GPUはbitsandbytes、CPUはoptimum-quantoのQuantoConfig）、small: 小さいモデルをCPUのfloat32で、
+    stub: モデルを使わない決定的な回答
+
+    :param backend: str: BACKENDSのどれか
+    :param model_id: str: HuggingFaceのモデル名
+    :param HF_API: str: HuggingFaceのAPIキー
+    :return: tuple: (model, tokenizer, generator)
+    '''
+
+    if backend not in BACKENDS:
+        raise ValueError(f"backendは{BACKENDS}のどれかを指定してください: {backend}")
+
+    if backend == 'stub':
+        generator = StubPipeline()
+        return None, generator.tokenizer, MeteredPipeline(generator, generator.tokenizer)
+
+    # stub以外の場合のみtorchとtransformersを読み込む
+    import torch
+    import transformers
+    from transformers import (
+        pipeline,
+        AutoTokenizer,
+        AutoModelForCausalLM,
+    )
+
+    # モデルのロード
+    model_config = transformers.AutoConfig.from_pretrained(
+        model_id,
+        token=HF_API
+    )
+
+    model_kwargs = dict(
+        trust_remote_code=True,
+        config=model_config,
+        token=HF_API,
+        low_cpu_mem_usage=True, # if true, create multiple processes or threads to handle loading and offloading -> slow
+        weights_only=True
+    )
+    if backend == 'fp16':
+        model_kwargs.update(torch_dtype=torch.float16, device_map='auto')
+    elif backend in ('int8', 'int4') and torch.cuda.is_available():
+        from transformers import BitsAndBytesConfig
+        if backend == 'int8':
+            model_kwargs.update(quantization_config=BitsAndBytesConfig(load_in_8bit=True), device_map='auto')
+        else:
+            model_kwargs.update(quantization_config=BitsAndBytesConfig(
+                load_in_4bit=True, bnb_4bit_quant_type="nf4", bnb_4bit_compute_dtype=torch.float16), device_map='auto')
+    elif backend in ('int8', 'int4'):
+        # float32で全体を読み込んでから量子化するとfp16の倍のメモリが要るため、読み込みながら量子化する
+        try:
+            import optimum.quanto  # noqa: F401
+        except ImportError:
+            raise ImportError(f"GPUの無い環境で{backend}を使う場合は optimum-quanto をインストールしてください"
+                              "（または --backend small を使ってください）")
+        from transformers import QuantoConfig
+        model_kwargs.update(quantization_config=QuantoConfig(weights=backend), torch_dtype=torch.float32,
+                            device_map='cpu')
+    else:
+        model_kwargs.update(torch_dtype=torch.float32)
+
+    model = AutoModelForCausalLM.from_pretrained(model_id, **model_kwargs)
+
+    # Set device
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_id,  # モデル名
+        add_eos_token=True,  # データへのEOSの追加を指示
+        trust_remote_code=True,
+        token=HF_API,
+    )
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "right"
+
+    generator = pipeline(
+        "text-generation",
+        model=model,
+        tokenizer=tokenizer,
+        max_new_tokens=512,
+        temperature=0.5,
+    )
+
+    return model, tokenizer, MeteredPipeline(generator, tokenizer)
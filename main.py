@@ -1,13 +1,17 @@
 from api_config import EDINET_API, HF_API_KEY
 from utils import GetData
+from cache import DocumentCache
+from meta_store import MetaStore
 from display import *
-from llm_analyzer import LLMAnalyzer
 from datetime import datetime
 import argparse
 import pandas as pd
 import warnings
 from pathlib import Path
 from cal import *
+from metrics import METRICS, Profiler
+from llm_backends import BACKENDS
+import atexit
 
 
 def parse_args() -> argparse:
@@ -44,6 +48,140 @@ def parse_args() -> argparse:
         help="習得したい日：　ない場合は本日のデータ使用: フォーマット '%Y-%m-%d'",
         required=False,
     )
+    parser.add_argument(
+        "--backfill_from",
+        "-bf",
+        type=str,
+        help="書類一覧をまとめて習得する開始日（--get_dateまたは本日まで）: フォーマット YYYY-MM-DD",
+        required=False,
+    )
+    parser.add_argument(
+        "--plot",
+        type=str,
+        choices=PLOT_MODES,
+        default="show",
+        help="グラフの出力方法（show: 表示、html/json/image: reportsに保存、none: 作らない）",
+        required=False,
+    )
+    parser.add_argument(
+        "--no_llm",
+        "--no-llm",
+        action="store_true",
+        help="LLMの分析をせずに比率の計算までを行う",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        default="fp16",
+        help="LLMの推論方法（fp16: ディフォルト、int8/int4: 量子化、small: 小さいモデル、stub: テスト用）",
+        required=False,
+    )
+    parser.add_argument(
+        "--analysis",
+        type=str,
+        choices=['agent', 'facts'],
+        default="agent",
+        help="分析方法（agent: ReActのエージェント、facts: 比率を先に計算して一回の生成で分析）",
+        required=False,
+    )
+    parser.add_argument(
+        "--max_iterations",
+        type=int,
+        default=4,
+        help="agentの場合のツールの呼び出し回数の上限",
+        required=False,
+    )
+    parser.add_argument(
+        "--news",
+        type=str,
+        choices=['duckduckgo', 'fixture'],
+        default="duckduckgo",
+        help="news_searchの検索先（fixture: news_fixtures.jsonを使うオフライン実行）",
+        required=False,
+    )
+    parser.add_argument(
+        "--news_ttl",
+        type=float,
+        default=3600,
+        help="ニュース検索のキャッシュの有効秒数",
+        required=False,
+    )
+    parser.add_argument(
+        "--news_timeout",
+        type=float,
+        default=10,
+        help="ニュース検索のタイムアウト秒数",
+        required=False,
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="生成キャッシュ（generation_cache）を使わずに分析し直す",
+    )
+    parser.add_argument(
+        "--generation_cache_max_mb",
+        type=float,
+        help="生成キャッシュの上限サイズ(MB)：　ない場合は無制限",
+        required=False,
+    )
+    parser.add_argument(
+        "--worker",
+        type=str,
+        help="起動中の分析ワーカーのURL（python analyzer_server.py で起動、例: http://127.0.0.1:8765）",
+        required=False,
+    )
+    parser.add_argument(
+        "--edinet_url",
+        type=str,
+        default="https://disclosure.edinet-fsa.go.jp/api/v2",
+        help="EDINET APIのURL（edinet_stub.pyを使う場合は http://127.0.0.1:8766/api/v2）",
+        required=False,
+    )
+    parser.add_argument(
+        "--max_workers",
+        "-mw",
+        type=int,
+        default=4,
+        help="書類ダウンロードの並列数",
+        required=False,
+    )
+    parser.add_argument(
+        "--save_csv",
+        action="store_true",
+        help="PriorとCurrentのCSVをcompany_finance_dataに保存する",
+    )
+    parser.add_argument(
+        "--fact_store",
+        action="store_true",
+        help="XBRLのデータをcompany_fact_storeにParquetで保存する（pyarrowが必要）",
+    )
+    parser.add_argument(
+        "--cache_max_mb",
+        type=float,
+        help="書類キャッシュの上限サイズ(MB)：　ない場合は無制限",
+        required=False,
+    )
+    parser.add_argument(
+        "--cache_max_age",
+        type=float,
+        help="書類キャッシュの保存日数：　ない場合は無制限",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="段階ごとの時間とカウンターの保存先（.promはPrometheus、それ以外はJSON Lines）",
+        required=False,
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        choices=['cprofile', 'tracemalloc'],
+        help="実行全体をcProfile（関数ごとの時間）かtracemalloc（メモリ確保）で計測してreportsに保存する",
+        required=False,
+    )
 
     return parser.parse_args()
 
@@ -55,12 +193,21 @@ if __name__ == '__main__':
         warnings.warn("APIを習得してapi_config.pyに保存してください: EDINET_API = 習得したAPI")
         exit()
 
-    if HF_API_KEY is None:
+    args = parse_args()
+
+    if HF_API_KEY is None and not args.no_llm and args.backend != 'stub':
         warnings.warn("HuggingFace API KEY がありません：")
         warnings.warn("APIを習得してapi_config.pyに保存してください: HF_API_KEY = 習得したAPI")
         exit()
 
-    args = parse_args()
+    # 途中でexitした場合も終了時に計測結果を保存する
+    if args.profile:
+        profiler = Profiler(args.profile)
+        profiler.start()
+        atexit.register(lambda: print(f"プロファイルを保存しました: {profiler.stop()}"))
+    if args.metrics:
+        atexit.register(lambda: print(f"計測結果を保存しました: {METRICS.export(args.metrics)}"))
+
     docid = args.docid
     company_name = args.company_name
 
@@ -72,7 +219,18 @@ if __name__ == '__main__':
         warnings.warn("docID(書類管理番号)か会社名のどちらかを与えてください。")
         exit()
 
-    get_data_utilis = GetData(EDINET_API)
+    cache = DocumentCache(
+        max_bytes=int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None,
+        max_age_days=args.cache_max_age,
+    )
+    # ダウンロードのない実行でも上限を超えた書類が残らないように、実行ごとに一度削除する
+    cache.evict()
+    fact_store = None
+    if args.fact_store:
+        from fact_store import FactStore
+        fact_store = FactStore()
+    get_data_utilis = GetData(EDINET_API, max_workers=args.max_workers, cache=cache, fact_store=fact_store,
+                              base_url=args.edinet_url)
 
     if not docid:
         # 会社の情報の習得
@@ -88,20 +246,26 @@ if __name__ == '__main__':
         else:
             get_date = datetime.today().strftime('%Y-%m-%d')
 
-        if Path(f'./company_csv_folder/data_{get_date}.csv').exists():
-            df = pd.read_csv(f'./company_csv_folder/data_{get_date}.csv')
+        # その日のうちに保存したCSVは書類が増えている可能性があるため習得し直す
+        csv_path = Path(f'./company_csv_folder/data_{get_date}.csv')
+        fetched_at = datetime.fromtimestamp(csv_path.stat().st_mtime) if csv_path.exists() else None
+        if fetched_at is not None and fetched_at.strftime('%Y-%m-%d') > get_date:
+            df = pd.read_csv(csv_path)
         else:
             df = get_data_utilis.create_csv(get_date)
+            fetched_at = None
+
+        # 書類一覧の索引を更新（未登録の日付のみ）
+        meta_store = MetaStore()
+        meta_store.import_csv_folder()
+        if args.backfill_from:
+            get_data_utilis.backfill_meta_data(args.backfill_from, get_date, meta_store)
+        meta_store.upsert(df, get_date, fetched_at)
 
         # 会社のdocid(書類管理番号)の習得
         docid = df[df['filerName'] == company_name]['docID']
         if docid.empty:
-            all_dfs = [data for data in Path('./company_csv_folder/').rglob("data_*.csv")]
-            for path in all_dfs:
-                temp = pd.read_csv(path)
-                docid = temp[temp['filerName'] == company_name]['docID']
-                if not docid.empty:
-                    break
+            docid = pd.Series(meta_store.find_doc_ids(company_name), dtype=object)
         df.to_csv(f'./company_csv_folder/data_{get_date}.csv', index=False)
 
     if len(docid) == 0:
@@ -117,10 +281,32 @@ if __name__ == '__main__':
     else:
         search_data.append(company_name)
 
-    finance_csv_list = get_data_utilis.get_finance_data(search_data)
-    result_list = display_bs(finance_csv_list, args.individual)
+    finance_frames = get_data_utilis.get_finance_frames_by_id(search_data, save_csv=args.save_csv)
+    result_list = display_bs(finance_frames, args.individual, plot=args.plot)
     cal_results(result_list)
+    if not result_list:
+        exit()
+
+    if args.no_llm:
+        exit()
 
     print(f"\n--- Analyzing Balance Sheet Data ---")
-    agent = LLMAnalyzer(HF_API_KEY)
-    agent.agent_analyze(result_list)
\ No newline at end of file
+    if args.worker:
+        # モデルをロード済みのワーカーに依頼する
+        from analyzer_server import submit_analysis
+        print(submit_analysis(result_list, args.worker, analysis=args.analysis))
+        exit()
+
+    from llm_analyzer import LLMAnalyzer, NEWS_CACHE_PATH  # torch・transformers・LangChainは分析する場合のみ読み込む
+    from news import NewsClient, create_news_backend
+    from generation_cache import GenerationCache
+    news = NewsClient(create_news_backend(args.news), ttl=args.news_ttl, timeout=args.news_timeout,
+                      cache_path=NEWS_CACHE_PATH)
+    max_bytes = int(args.generation_cache_max_mb * 1024 * 1024) if args.generation_cache_max_mb else None
+    agent = LLMAnalyzer(HF_API_KEY, backend=args.backend, news=news,
+                        generation_cache=GenerationCache(max_bytes=max_bytes), refresh=args.refresh)
+    if args.analysis == 'facts':
+        agent.facts_analyze(result_list)
+    else:
+        agent.agent_analyze(result_list, max_iterations=args.max_iterations)
+    agent.report_stats()
\ No newline at end of file
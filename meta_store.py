@@ -0,0 +1,159 @@
+import sqlite3
+import threading
+import pandas as pd
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+
+# documents.jsonから保存する列
+COLUMNS = [
+    "docID", "edinetCode", "secCode", "JCN", "filerName", "fundCode", "ordinanceCode", "formCode",
+    "docTypeCode", "periodStart", "periodEnd", "submitDateTime", "docDescription", "parentDocID",
+    "withdrawalStatus", "csvFlag",
+]
+
+
+class MetaStore:
+    '''EDINETの書類一覧（documents.json）をSQLiteに保存する索引
+
+    filerName・edinetCode・secCode・docTypeCodeに索引を作り、
+    日毎のCSVを全て読み直さずに会社名から書類管理番号(docID)を検索する。
+    その日が終わる前に習得した一覧は書類が増えるため、取り込み済み（complete）にしない。
+    '''
+
+    def __init__(self, db_path: str = './company_csv_folder/meta.sqlite3') -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._create_tables()
+
+
+    def _create_tables(self) -> None:
+        cols = ", ".join(f"{c} TEXT" for c in COLUMNS if c != "docID")
+        with self.lock, self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS filings (docID TEXT PRIMARY KEY, {cols}, fetchDate TEXT)")
+            for c in ["filerName", "edinetCode", "secCode", "docTypeCode"]:
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_filings_{c} ON filings ({c}, submitDateTime)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS synced_dates "
+                              "(date TEXT PRIMARY KEY, count INTEGER, complete INTEGER)")
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(synced_dates)")}
+            if "complete" not in columns:
+                # 以前の索引はいつ習得したか分からないため、一度だけ習得し直す
+                self.conn.execute("ALTER TABLE synced_dates ADD COLUMN complete INTEGER")
+
+
+    @staticmethod
+    def _normalize(value) -> Optional[str]:
+        if value is None or (isinstance(value, float) and pd.isna(value)):
+            return None
+        if isinstance(value, float) and value.is_integer():
+            # read_csvで数値になったsecCodeなどを元の文字列に戻す
+            return str(int(value))
+        value = str(value)
+        if value.endswith(".0") and value[:-2].isdigit():
+            return value[:-2]
+        return value if value != "" else None
+
+
+    def upsert(self, df: pd.DataFrame, get_date: str, fetched_at: Optional[datetime] = None) -> int:
+        '''一日分の書類一覧を追加・更新する
+
+        :param df: pd.DataFrame: GetData.create_csvの結果
+        :param get_date: str: 取得日 '%Y-%m-%d'
+        :param fetched_at: datetime: 一覧を習得した日時（Noneは現在）。get_dateより後なら取り込み済みにする
+        :return: int: 保存した件数
+        '''
+
+        rows = []
+        if not df.empty and "docID" in df.columns:
+            present = [c for c in COLUMNS if c in df.columns]
+            for record in df[present].itertuples(index=False, name=None):
+                row = dict(zip(present, (self._normalize(v) for v in record)))
+                if row.get("docID"):
+                    rows.append(tuple(row.get(c) for c in COLUMNS) + (get_date,))
+
+        fetched_at = fetched_at or datetime.now()
+        complete = int(fetched_at.date() > datetime.strptime(get_date, '%Y-%m-%d').date())
+
+        placeholders = ", ".join("?" * (len(COLUMNS) + 1))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO filings ({', '.join(COLUMNS)}, fetchDate) VALUES ({placeholders})", rows)
+            self.conn.execute("INSERT OR REPLACE INTO synced_dates (date, count, complete) VALUES (?, ?, ?)",
+                              (get_date, len(rows), complete))
+        return len(rows)
+
+
+    def import_csv_folder(self, folder: str = './company_csv_folder') -> int:
+        '''保存済みのdata_*.csvのうち、未登録の日付だけを取り込む
+
+        ファイルの更新日時を習得した日時とみなし、その日のうちに保存したCSVは取り込み済みにしない。
+
+        :param folder: str:
+        :return: int: 取り込んだファイル数
+        '''
+
+        synced = self.synced_dates()
+        count = 0
+        for path in sorted(Path(folder).glob("data_*.csv")):
+            get_date = path.stem.replace("data_", "")
+            if get_date in synced:
+                continue
+            self.upsert(pd.read_csv(path, dtype=str), get_date, datetime.fromtimestamp(path.stat().st_mtime))
+            count += 1
+        return count
+
+
+    def synced_dates(self) -> set:
+        '''取り込み済みの日付（その日が終わった後に習得した日付のみ）
+
+        :return: set
+        '''
+
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT date FROM synced_dates WHERE complete = 1")}
+
+
+    def query(self, filer_name: str = None, edinet_code: str = None, sec_code: str = None,
+              doc_type_code: str = None) -> pd.DataFrame:
+        '''条件に合う書類を新しい順に返す
+
+        :param filer_name: str: 会社名
+        :param edinet_code: str: EDINETコード
+        :param sec_code: str: 証券コード
+        :param doc_type_code: str: 書類種別コード（120は有価証券報告書）
+        :return: pd.DataFrame
+        '''
+
+        conditions, params = [], []
+        for column, value in [("filerName", filer_name), ("edinetCode", edinet_code),
+                              ("secCode", sec_code), ("docTypeCode", doc_type_code)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(str(value))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self.lock:
+            return pd.read_sql_query(
+                f"SELECT * FROM filings {where} ORDER BY submitDateTime DESC", self.conn, params=params)
+
+
+    def find_doc_ids(self, filer_name: str, doc_type_code: str = None) -> list:
+        '''会社名から一番新しい提出日の書類管理番号(docID)を返す
+
+        :param filer_name: str: 会社名
+        :param doc_type_code: str: 書類種別コード
+        :return: list
+        '''
+
+        df = self.query(filer_name=filer_name, doc_type_code=doc_type_code)
+        if df.empty:
+            return []
+        latest = df["submitDateTime"].fillna("").str[:10]
+        return df[latest == latest.iloc[0]]["docID"].tolist()
+
+
+    def close(self) -> None:
+        self.conn.close()
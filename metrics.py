@@ -0,0 +1,282 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windowsではpsutilがある場合のみ測る
+    resource = None
+
+
+PROFILE_MODES = ['cprofile', 'tracemalloc']
+
+# Prometheusの名前の接頭辞
+PROMETHEUS_PREFIX = "edinet_"
+
+
+def peak_rss_mb() -> float:
+    '''プロセスの最大メモリ使用量(MB)'''
+
+    if resource is None:
+        try:
+            import psutil
+        except ImportError:
+            return 0.0
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / (1024 * 1024)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def percentile(values: list, q: float) -> float:
+    '''q（0～100）パーセンタイル（最も近い順位）'''
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+class Metrics:
+    '''段階ごとの時間（span）とカウンターを記録する（スレッドセーフ）
+
+    spanは一回ごとにdocIDなどのラベルと一緒に記録し、JSON Linesでそのまま、
+    Prometheusでは doc_id 以外のラベルでまとめて出力する。
+    '''
+
+    def __init__(self, max_events: int = 100000) -> None:
+        self.lock = threading.Lock()
+        self.max_events = max_events
+        self.reset()
+
+
+    def reset(self) -> None:
+        with self.lock:
+            self.events = []
+            self.durations = {}
+            self.counters = {}
+            self.peak_rss_mb = 0.0
+            self.started = time.time()
+
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        '''ブロックの時間を記録する
+
+        :param name: str: 段階の名前（http, download, extract など）
+        :param labels: doc_id などのラベル
+        '''
+
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, error=error, **labels)
+
+
+    def record(self, name: str, seconds: float, error: str = None, **labels) -> None:
+        '''spanの時間を記録する（spanを使えない場合）'''
+
+        rss = peak_rss_mb()
+        key = (name, self._series(labels))
+        with self.lock:
+            self.durations.setdefault(key, []).append(seconds)
+            self.peak_rss_mb = max(self.peak_rss_mb, rss)
+            if len(self.events) < self.max_events:
+                event = {"type": "span", "name": name, "seconds": round(seconds, 6), "time": time.time(), **labels}
+                if error is not None:
+                    event["error"] = error
+                self.events.append(event)
+
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        '''カウンターを増やす
+
+        :param name: str: カウンターの名前（bytes_downloaded, retries など）
+        :param value: float: 増やす値
+        :param labels: ラベル
+        '''
+
+        key = (name, self._series(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def sample_memory(self) -> float:
+        '''最大メモリ使用量(MB)を記録する'''
+
+        rss = peak_rss_mb()
+        with self.lock:
+            self.peak_rss_mb = max(self.peak_rss_mb, rss)
+        return self.peak_rss_mb
+
+
+    @staticmethod
+    def _series(labels: dict) -> tuple:
+        '''まとめる単位のラベル（doc_idは除く）'''
+        return tuple(sorted((k, str(v)) for k, v in labels.items() if k != "doc_id" and v is not None))
+
+
+    def summary(self) -> dict:
+        '''spanとカウンターのまとめ
+
+        :return: dict: {"spans": {名前: {count, seconds, p50_ms, p99_ms}}, "counters": {名前: 値}, "peak_rss_mb": float}
+        '''
+
+        self.sample_memory()
+        with self.lock:
+            durations = {k: list(v) for k, v in self.durations.items()}
+            counters = dict(self.counters)
+
+        def label(name, series):
+            return name + ("{" + ",".join(f"{k}={v}" for k, v in series) + "}" if series else "")
+
+        return {
+            "spans": {label(name, series): {"count": len(values), "seconds": round(sum(values), 6),
+                                            "p50_ms": round(percentile(values, 50) * 1000, 3),
+                                            "p99_ms": round(percentile(values, 99) * 1000, 3)}
+                      for (name, series), values in sorted(durations.items())},
+            "counters": {label(name, series): value for (name, series), value in sorted(counters.items())},
+            "peak_rss_mb": round(self.peak_rss_mb, 1),
+        }
+
+
+    def write_jsonl(self, path: str) -> Path:
+        '''spanを一行ずつ、最後にまとめを出力する
+
+        :param path: str: 保存先
+        :return: Path
+        '''
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        summary = self.summary()
+        with self.lock:
+            events = list(self.events)
+        with open(path, "a", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            f.write(json.dumps({"type": "summary", "time": time.time(), **summary}, ensure_ascii=False) + "\n")
+        return path
+
+
+    def to_prometheus(self) -> str:
+        '''Prometheusのテキスト形式
+
+        :return: str
+        '''
+
+        self.sample_memory()
+        with self.lock:
+            durations = {k: list(v) for k, v in self.durations.items()}
+            counters = dict(self.counters)
+
+        def labels(series, extra=()):
+            pairs = list(series) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        for name in sorted({n for n, _ in durations}):
+            metric = f"{PROMETHEUS_PREFIX}{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for (n, series), values in sorted(durations.items()):
+                if n != name:
+                    continue
+                for q in (0.5, 0.99):
+                    lines.append(f"{metric}{labels(series, [('quantile', q)])} {percentile(values, q * 100):.6f}")
+                lines.append(f"{metric}_sum{labels(series)} {sum(values):.6f}")
+                lines.append(f"{metric}_count{labels(series)} {len(values)}")
+        for name in sorted({n for n, _ in counters}):
+            metric = f"{PROMETHEUS_PREFIX}{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (n, series), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{metric}{labels(series)} {value}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}peak_rss_megabytes gauge")
+        lines.append(f"{PROMETHEUS_PREFIX}peak_rss_megabytes {self.peak_rss_mb:.1f}")
+        return "\n".join(lines) + "\n"
+
+
+    def export(self, path: str) -> Path:
+        '''拡張子で形式を選んで出力する（.promはPrometheus、それ以外はJSON Lines）
+
+        :param path: str: 保存先
+        :return: Path
+        '''
+
+        if str(path).endswith(".prom"):
+            path = Path(path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(self.to_prometheus(), encoding="utf-8")
+            return path
+        return self.write_jsonl(path)
+
+
+# プロセスで共有する記録
+METRICS = Metrics()
+
+
+class Profiler:
+    '''cProfileかtracemallocで実行全体を計測する
+
+    cprofile: 関数ごとの時間（.pstats を保存し、上位を表示）、
+    tracemalloc: 行ごとのメモリ確保（上位を保存・表示）
+    '''
+
+    def __init__(self, mode: str, output_dir: str = './reports', top: int = 20) -> None:
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"profileは{PROFILE_MODES}のどれかを指定してください: {mode}")
+        self.mode = mode
+        self.output_dir = Path(output_dir)
+        self.top = top
+        self.profiler = None
+
+
+    def start(self) -> None:
+        if self.mode == 'cprofile':
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            import tracemalloc
+            tracemalloc.start()
+
+
+    def stop(self) -> Path:
+        '''計測を止めて結果を保存する
+
+        :return: Path: 保存したファイル
+        '''
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        name = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+        if self.mode == 'cprofile':
+            import io
+            import pstats
+            self.profiler.disable()
+            path = self.output_dir / f"{name}.pstats"
+            self.profiler.dump_stats(path)
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(self.top)
+            print(out.getvalue())
+            return path
+
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        lines = [str(stat) for stat in snapshot.statistics("lineno")[:self.top]]
+        path = self.output_dir / f"{name}_tracemalloc.txt"
+        path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        print("\n".join(lines))
+        return path
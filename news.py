@@ -0,0 +1,213 @@
+import json
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future, TimeoutError
+from pathlib import Path
+from typing import Optional
+from metrics import METRICS
+from utils import RateLimiter
+
+
+NEWS_BACKENDS = ['duckduckgo', 'fixture']
+
+NO_NEWS = "No news found."
+
+# DuckDuckGoへの問い合わせの上限（回/秒）と同時に使える回数
+NEWS_RATE_LIMIT = 1.0
+NEWS_BURST = 2
+
+
+def normalize_query(query: str) -> str:
+    '''キャッシュのキーにするため、全角・半角と大文字・小文字、空白の違いをなくす
+
+    :param query: str:
+    :return: str
+    '''
+
+    query = unicodedata.normalize("NFKC", query or "")
+    return re.sub(r"\s+", " ", query).strip().strip('"\'').lower()
+
+
+class DuckDuckGoNewsBackend:
+    '''DuckDuckGoのニュース検索（LangChainのラッパーを一度だけ作る）'''
+
+    def __init__(self, region: str = "jp-jp", time_window: str = "d", max_results: int = 2) -> None:
+        self.region = region
+        self.time_window = time_window
+        self.max_results = max_results
+        self._engine = None
+
+    def search(self, query: str) -> str:
+        if self._engine is None:
+            from langchain_community.tools import DuckDuckGoSearchResults
+            from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
+
+            wrapper = DuckDuckGoSearchAPIWrapper(region=self.region, time=self.time_window,
+                                                 max_results=self.max_results)
+            self._engine = DuckDuckGoSearchResults(api_wrapper=wrapper, backend="news")
+        return self._engine.invoke(query)
+
+
+class FixtureNewsBackend:
+    '''JSONファイルのニュースを返す（オフライン・テスト用）
+
+    ファイルは {"検索語": "ニュースの文字列"} の形で、検索語は normalize_query で比べる。
+    '''
+
+    def __init__(self, path: str = './news_fixtures.json', region: str = "jp-jp", time_window: str = "d",
+                 max_results: int = 2) -> None:
+        self.path = Path(path)
+        self.region = region
+        self.time_window = time_window
+        self.max_results = max_results
+        self.fixtures = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                self.fixtures = {normalize_query(k): v for k, v in json.load(f).items()}
+
+    def search(self, query: str) -> str:
+        return self.fixtures.get(normalize_query(query), NO_NEWS)
+
+
+def create_news_backend(name: str = 'duckduckgo', **kwargs):
+    '''名前からニュースのバックエンドを作る
+
+    :param name: str: NEWS_BACKENDSのどれか
+    :return: DuckDuckGoNewsBackend | FixtureNewsBackend
+    '''
+
+    if name == 'duckduckgo':
+        return DuckDuckGoNewsBackend(**kwargs)
+    if name == 'fixture':
+        return FixtureNewsBackend(**kwargs)
+    raise ValueError(f"newsは{NEWS_BACKENDS}のどれかを指定してください: {name}")
+
+
+class NewsClient:
+    '''ニュース検索のTTLキャッシュ
+
+    同じ検索語（normalize_query）・地域・期間はTTLの間キャッシュから返し、
+    実行中の同じ検索は一つにまとめる。検索がtimeoutを超えた場合はエラーの文字列を返し、
+    次の同じ検索は新しく実行する（遅れて終わった検索の結果はキャッシュに入れる）。
+    検索はデーモンスレッドで実行するため、終わらない検索があってもプロセスは終了できる。
+    バックエンドへの問い合わせはトークンバケット（rate_limit回/秒）で間隔をあける。
+    cache_pathを指定した場合はキャッシュをJSONに保存し、次回の実行でも使う。
+    '''
+
+    def __init__(self, backend=None, ttl: float = 3600, timeout: float = 10,
+                 cache_path: Optional[str] = None, rate_limit: float = NEWS_RATE_LIMIT,
+                 burst: int = NEWS_BURST) -> None:
+        self.backend = backend if backend is not None else DuckDuckGoNewsBackend()
+        self.ttl = ttl
+        self.timeout = timeout
+        self.cache_path = Path(cache_path) if cache_path else None
+        self.lock = threading.Lock()
+        self.rate_limiter = RateLimiter(rate_limit, burst)
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.cache = self._load_cache()
+
+
+    def _load_cache(self) -> dict:
+        if self.cache_path is None or not self.cache_path.exists():
+            return {}
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            print(f"ニュースのキャッシュを読み込めないため作り直します: {self.cache_path}")
+            return {}
+
+
+    def _save_cache(self) -> None:
+        if self.cache_path is None:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.cache, f, ensure_ascii=False)
+        tmp.replace(self.cache_path)
+
+
+    def _key(self, query: str) -> str:
+        backend = self.backend
+        return "|".join([type(backend).__name__, getattr(backend, "region", ""),
+                         getattr(backend, "time_window", ""), str(getattr(backend, "max_results", "")),
+                         normalize_query(query)])
+
+
+    def search(self, query: str) -> str:
+        '''ニュースを検索する（キャッシュ・同時実行のまとめ・タイムアウトあり）
+
+        :param query: str: 検索語
+        :return: str: 検索結果かエラーの文字列
+        '''
+
+        key = self._key(query)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and time.time() - entry["time"] < self.ttl:
+                self.hits += 1
+                METRICS.count("news_cache_hits")
+                return entry["result"]
+
+            future = self.in_flight.get(key)
+            is_new = future is None
+            if is_new:
+                self.misses += 1
+                METRICS.count("news_cache_misses")
+                future = Future()
+                self.in_flight[key] = future
+
+        if is_new:
+            # 終わっている場合はこのスレッドで呼ばれるため、ロックの外で登録する
+            future.add_done_callback(lambda f: self._store(key, f))
+            threading.Thread(target=self._run, args=(future, query), name="news", daemon=True).start()
+
+        try:
+            with METRICS.span("news"):
+                return future.result(timeout=self.timeout)
+        except TimeoutError:
+            METRICS.count("news_timeouts")
+            with self.lock:
+                # 終わらない検索を待ち続けないように、次の同じ検索は新しく実行する
+                if self.in_flight.get(key) is future:
+                    del self.in_flight[key]
+            return f"Error: news search timed out after {self.timeout} seconds."
+        except Exception as e:
+            return f"Error: news search failed: {e}"
+
+
+    def _run(self, future: Future, query: str) -> None:
+        '''デーモンスレッドで検索し、結果をfutureに入れる'''
+
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            self.rate_limiter.acquire()
+            result = self.backend.search(query)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+
+    def _store(self, key: str, future: Future) -> None:
+        '''検索が終わったらキャッシュに入れる（失敗した検索は入れない）'''
+
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+            if future.exception() is not None:
+                return
+            now = time.time()
+            self.cache = {k: v for k, v in self.cache.items() if now - v["time"] < self.ttl}
+            self.cache[key] = {"time": now, "result": future.result()}
+            self._save_cache()
+
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "cached": len(self.cache)}
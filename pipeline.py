@@ -0,0 +1,379 @@
+import argparse
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from analyzer_server import frames_to_payload, payload_to_frames
+from cal import cal_ratios, frames_to_bs_table
+from display import extract_bs, build_bs_figures, render_report
+from metrics import METRICS
+from llm_backends import BACKENDS
+
+
+STAGES = ['download', 'extract', 'analyze']
+
+DOC_ID_PATTERN = re.compile(r"^S[0-9A-Z]{7}$")
+
+_DONE = object()  # キューの終わりの印
+
+
+class Checkpoint:
+    '''書類ごと・段階ごとの状態をSQLiteに保存する
+
+    落ちた場合でも、完了した段階は次の実行で飛ばす。
+    '''
+
+    def __init__(self, db_path: str = './pipeline_state/checkpoint.sqlite3') -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS stages (docID TEXT, stage TEXT, status TEXT, "
+                              "result TEXT, error TEXT, updated REAL, PRIMARY KEY (docID, stage))")
+
+
+    def mark(self, doc_id: str, stage: str, status: str, result=None, error: str = None) -> None:
+        '''段階の状態を保存する
+
+        :param doc_id: str: 書類管理番号
+        :param stage: str: STAGESのどれか
+        :param status: str: done, failed, skipped
+        :param result: JSONにできる結果
+        :param error: str: エラーの内容
+        :return: None
+        '''
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)",
+                (doc_id, stage, status, json.dumps(result, ensure_ascii=False, default=str), error, time.time()))
+
+
+    def get(self, doc_id: str) -> dict:
+        '''書類の各段階の状態
+
+        :param doc_id: str:
+        :return: dict: {stage: {"status": str, "result": ..., "error": str}}
+        '''
+
+        with self.lock:
+            rows = self.conn.execute("SELECT stage, status, result, error FROM stages WHERE docID = ?",
+                                     (doc_id,)).fetchall()
+        return {stage: {"status": status, "result": json.loads(result) if result else None, "error": error}
+                for stage, status, result, error in rows}
+
+
+    def summary(self) -> dict:
+        '''段階ごと・状態ごとの件数
+
+        :return: dict: {stage: {status: int}}
+        '''
+
+        with self.lock:
+            rows = self.conn.execute("SELECT stage, status, COUNT(*) FROM stages GROUP BY stage, status").fetchall()
+        result = {}
+        for stage, status, count in rows:
+            result.setdefault(stage, {})[status] = count
+        return result
+
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def resolve_doc_ids(targets: list, meta_store=None) -> list:
+    '''会社名か書類管理番号のリストを書類管理番号のリストにする
+
+    :param targets: list: 会社名か書類管理番号(docID)
+    :param meta_store: MetaStore: 会社名を検索する索引（Noneは会社名を使わない）
+    :return: list: 重複のない書類管理番号
+    '''
+
+    doc_ids = []
+    for target in targets:
+        target = target.strip()
+        if not target:
+            continue
+        if DOC_ID_PATTERN.match(target):
+            found = [target]
+        elif meta_store is not None:
+            found = meta_store.find_doc_ids(target)
+            if not found:
+                print(f"書類管理番号(docID)が見つかりません: {target}")
+        else:
+            print(f"会社名を検索する索引がありません: {target}")
+            found = []
+        doc_ids.extend(d for d in found if d not in doc_ids)
+    return doc_ids
+
+
+class Pipeline:
+    '''複数の書類をダウンロード・抽出・分析の段階に分けて並行に処理する
+
+    段階の間は上限のあるキューでつなぎ、ダウンロード（I/O）は複数のスレッド、
+    抽出・比率の計算とLLMの分析はそれぞれ一つのスレッドで行う。
+    一つの書類の失敗は記録して次の書類に進み、完了した段階はCheckpointから再開する。
+    '''
+
+    def __init__(self, get_data, analyzer=None, checkpoint: Checkpoint = None, individual: bool = True,
+                 plot: str = 'none', report_dir: str = './reports', analysis: str = 'facts',
+                 download_workers: int = 4, queue_size: int = 8) -> None:
+        self.get_data = get_data
+        self.analyzer = analyzer
+        self.checkpoint = checkpoint if checkpoint is not None else Checkpoint()
+        self.individual = individual
+        self.plot = plot
+        self.report_dir = report_dir
+        self.analysis = analysis
+        self.download_workers = max(1, download_workers)
+        self.queue_size = queue_size
+
+        self.results = {}
+        self.results_lock = threading.Lock()
+
+
+    def _record(self, doc_id: str, stage: str, status: str, result=None, error: str = None) -> None:
+        self.checkpoint.mark(doc_id, stage, status, result, error)
+        METRICS.count("pipeline_documents", stage=stage, status=status)
+        with self.results_lock:
+            self.results.setdefault(doc_id, {})[stage] = status
+        message = f"{doc_id} {stage}: {status}"
+        print(message if error is None else f"{message} ({error})")
+
+
+    def _download_worker(self, in_queue: queue.Queue, out_queue: queue.Queue) -> None:
+        while True:
+            doc_id = in_queue.get()
+            if doc_id is _DONE:
+                return
+            try:
+                frames = self.get_data.get_finance_frames([doc_id])
+                if not frames:
+                    self._record(doc_id, 'download', 'failed', error="書類を読み込めません")
+                    continue
+                self._record(doc_id, 'download', 'done')
+                out_queue.put((doc_id, frames[0]))
+            except Exception as e:
+                self._record(doc_id, 'download', 'failed', error=str(e))
+
+
+    def _extract_worker(self, in_queue: queue.Queue, out_queue: queue.Queue) -> None:
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                return
+            doc_id, frames = item
+            try:
+                titled_frames = extract_bs({doc_id: frames}, self.individual).get(doc_id)
+                if not titled_frames:
+                    self._record(doc_id, 'extract', 'failed', error="バランスシートを抽出できません")
+                    continue
+
+                df_list = [df for _, df in titled_frames]
+                with METRICS.span("ratios", doc_id=doc_id):
+                    ratios = cal_ratios(frames_to_bs_table(df_list))
+                if self.plot not in ('none', 'show'):
+                    render_report(build_bs_figures(titled_frames), self.plot, self.report_dir, name=f"bs_{doc_id}")
+
+                result = {"frames": frames_to_payload(df_list), "ratios": ratios.to_dict(orient="records")}
+                self._record(doc_id, 'extract', 'done', result)
+                if self.analyzer is not None:
+                    out_queue.put((doc_id, df_list))
+            except Exception as e:
+                self._record(doc_id, 'extract', 'failed', error=str(e))
+
+
+    def _analyze_worker(self, in_queue: queue.Queue) -> None:
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                return
+            doc_id, df_list = item
+            try:
+                if self.analysis == 'agent':
+                    output = self.analyzer.agent_analyze(df_list)
+                else:
+                    output = self.analyzer.facts_analyze(df_list)
+                self._record(doc_id, 'analyze', 'done', {"output": output})
+            except Exception as e:
+                self._record(doc_id, 'analyze', 'failed', error=str(e))
+
+
+    def _feed(self, doc_ids: list, download_queue: queue.Queue, analyze_queue: queue.Queue) -> None:
+        '''完了した段階を飛ばして、書類を最初の未完了の段階のキューに入れる'''
+
+        for doc_id in doc_ids:
+            state = self.checkpoint.get(doc_id)
+            extracted = state.get('extract', {}).get('status') == 'done'
+            analyzed = state.get('analyze', {}).get('status') == 'done'
+
+            with self.results_lock:
+                self.results[doc_id] = {stage: state[stage]["status"] for stage in state if extracted}
+            if extracted and (self.analyzer is None or analyzed):
+                continue
+            if extracted:
+                analyze_queue.put((doc_id, payload_to_frames(state['extract']['result']['frames'])))
+            else:
+                download_queue.put(doc_id)
+
+
+    def run(self, doc_ids: list) -> dict:
+        '''書類をまとめて処理する
+
+        :param doc_ids: list: 書類管理番号(docID)
+        :return: dict: {docID: {stage: status}}
+        '''
+
+        download_queue = queue.Queue(self.queue_size)
+        extract_queue = queue.Queue(self.queue_size)
+        analyze_queue = queue.Queue(self.queue_size)
+
+        feeder = threading.Thread(target=self._feed, args=(doc_ids, download_queue, analyze_queue))
+        downloaders = [threading.Thread(target=self._download_worker, args=(download_queue, extract_queue))
+                       for _ in range(self.download_workers)]
+        extractor = threading.Thread(target=self._extract_worker, args=(extract_queue, analyze_queue))
+        analyzer = threading.Thread(target=self._analyze_worker, args=(analyze_queue,))
+
+        for thread in [feeder, *downloaders, extractor, analyzer]:
+            thread.start()
+
+        # 前の段階が終わったら次の段階に終わりの印を送る
+        feeder.join()
+        for _ in downloaders:
+            download_queue.put(_DONE)
+        for thread in downloaders:
+            thread.join()
+        extract_queue.put(_DONE)
+        extractor.join()
+        analyze_queue.put(_DONE)
+        analyzer.join()
+
+        return {doc_id: self.results.get(doc_id, {}) for doc_id in doc_ids}
+
+
+def parse_args() -> argparse:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        help="会社名か書類管理番号(docID)",
+    )
+    parser.add_argument(
+        "--targets_file",
+        "-f",
+        type=str,
+        help="一行に一つの会社名か書類管理番号(docID)を書いたファイル",
+        required=False,
+    )
+    parser.add_argument(
+        "--individual",
+        type=eval,
+        choices=[True, False],
+        default=True,
+        help="個別のデータを使う（無い場合は連結）",
+        required=False,
+    )
+    parser.add_argument(
+        "--plot",
+        type=str,
+        choices=['html', 'json', 'image', 'none'],
+        default="none",
+        help="グラフの出力方法（html/json/image: reportsに保存）",
+        required=False,
+    )
+    parser.add_argument(
+        "--analysis",
+        type=str,
+        choices=['facts', 'agent', 'none'],
+        default="facts",
+        help="LLMの分析方法（none: 比率の計算まで）",
+        required=False,
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        default="fp16",
+        help="LLMの推論方法",
+        required=False,
+    )
+    parser.add_argument(
+        "--edinet_url",
+        type=str,
+        default="https://disclosure.edinet-fsa.go.jp/api/v2",
+        help="EDINET APIのURL（edinet_stub.pyを使う場合は http://127.0.0.1:8766/api/v2）",
+        required=False,
+    )
+    parser.add_argument(
+        "--max_workers",
+        "-mw",
+        type=int,
+        default=4,
+        help="書類ダウンロードの並列数",
+        required=False,
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=8,
+        help="段階の間のキューの上限",
+        required=False,
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default="./pipeline_state/checkpoint.sqlite3",
+        help="段階ごとの状態の保存先（同じファイルで再実行すると続きから処理する）",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="段階ごとの時間とカウンターの保存先（.promはPrometheus、それ以外はJSON Lines）",
+        required=False,
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from api_config import EDINET_API, HF_API_KEY
+    from cache import DocumentCache
+    from meta_store import MetaStore
+    from utils import GetData
+
+    args = parse_args()
+
+    targets = list(args.targets)
+    if args.targets_file:
+        with open(args.targets_file, encoding="utf-8") as f:
+            targets.extend(line.strip() for line in f)
+
+    doc_ids = resolve_doc_ids(targets, MetaStore())
+    if not doc_ids:
+        print("処理する書類がありません")
+        exit()
+
+    analyzer = None
+    if args.analysis != 'none':
+        from llm_analyzer import LLMAnalyzer
+        analyzer = LLMAnalyzer(HF_API_KEY, backend=args.backend)
+
+    # ダウンロードのスレッドがセッションを共有するため、コネクションプールもスレッドの数にする
+    get_data_utilis = GetData(EDINET_API, max_workers=args.max_workers, cache=DocumentCache(),
+                              base_url=args.edinet_url)
+    pipeline = Pipeline(get_data_utilis, analyzer, Checkpoint(args.checkpoint), args.individual, args.plot,
+                        analysis=args.analysis, download_workers=args.max_workers, queue_size=args.queue_size)
+
+    start = time.perf_counter()
+    pipeline.run(doc_ids)
+    print(json.dumps(pipeline.checkpoint.summary(), ensure_ascii=False, indent=2))
+    print(f"{len(doc_ids)}件の書類を{round(time.perf_counter() - start, 2)}秒で処理しました")
+    if args.metrics:
+        print(f"計測結果を保存しました: {METRICS.export(args.metrics)}")
@@ -6,11 +6,100 @@ import zipfile
 from typing import Tuple
 import io
 import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from cache import DocumentCache
+from meta_store import MetaStore
+from metrics import METRICS
+
+
+# EDINET APIのURL（edinet_stub.pyなどのローカルのサーバーを使う場合は変更する）
+EDINET_BASE_URL = 'https://disclosure.edinet-fsa.go.jp/api/v2'
+
+# EDINET APIのリクエスト上限（1秒あたりのリクエスト数とバースト）
+EDINET_RATE_LIMIT = 1.0
+EDINET_BURST = 3
+
+# バランスシートの抽出に必要な列と型
+XBRL_COLUMNS = ['要素ID', '項目名', 'コンテキストID', '連結・個別', '値']
+XBRL_DTYPES = {'要素ID': 'category', '項目名': 'category', 'コンテキストID': 'category',
+               '連結・個別': 'category', '値': str}
+
+
+def is_target_member(file:str) -> bool:
+    """ZIPのメンバーが有価証券報告書(jpcrp)か投資信託(jpsps)のCSVか"""
+    return (file.startswith("XBRL_TO_CSV/jpcrp") or file.startswith("XBRL_TO_CSV/jpsps")) and file.endswith(".csv")
+
+
+def read_xbrl_csv(file, usecols:list = XBRL_COLUMNS) -> pd.DataFrame:
+    """EDINETのCSV(UTF-16、タブ区切り)を読み込む
+
+    :param file: パスまたはファイルオブジェクト
+    :param usecols: list: 読み込む列（Noneは全ての列）
+    :return: pd.DataFrame
+    """
+
+    dtype = {c: t for c, t in XBRL_DTYPES.items() if usecols is None or c in usecols}
+    return pd.read_csv(file, encoding="utf-16", sep="\t", usecols=usecols, dtype=dtype)
+
+
+def split_frame_with_prior_current(df:pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """データをPriorとCurrentに分ける
+
+    :param df: pd.DataFrame:
+    :return: Tuple[pd.DataFrame, pd.DataFrame]
+    """
+
+    is_prior = df['コンテキストID'].astype(str).str.contains("Prior").to_numpy()
+    return df[is_prior], df[~is_prior]
+
+
+class RateLimiter:
+    """トークンバケット方式のレートリミッター（スレッドセーフ）"""
+
+    def __init__(self, rate: float = EDINET_RATE_LIMIT, burst: int = EDINET_BURST) -> None:
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """トークンが得られるまで待機する"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            METRICS.count("rate_limit_wait_seconds", wait)
+            time.sleep(wait)
 
 
 class GetData:
-    def __init__(self, EDINET_API:str) -> None:
+    def __init__(self, EDINET_API:str, max_workers:int = 4, rate_limit:float = EDINET_RATE_LIMIT,
+                 burst:int = EDINET_BURST, max_retries:int = 3, backoff:float = 1.0,
+                 cache:DocumentCache = None, fact_store=None, base_url:str = EDINET_BASE_URL) -> None:
         self.api = EDINET_API
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache if cache is not None else DocumentCache()
+        self.fact_store = fact_store  # fact_store.FactStore（Noneは保存しない）
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limiter = RateLimiter(rate_limit, burst)
+
+        # コネクションプールを共有するセッション
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
 
     def get_company_meta_data(self, get_date:str) -> json:
@@ -21,7 +110,7 @@ class GetData:
         '''
 
         # APIのエンドポイント
-        url = 'https://disclosure.edinet-fsa.go.jp/api/v2/documents.json'
+        url = f'{self.base_url}/documents.json'
 
         # パラメータの設定
         params = {
@@ -30,11 +119,8 @@ class GetData:
             "Subscription-Key": self.api
         }
 
-        # APIリクエストを送信
-        response = requests.get(url, params=params)
-
-        # レスポンスのJSONデータを取得
-        return response.json()
+        # APIリクエストを送信（レスポンスのJSONデータを取得）
+        return json.loads(self._request_with_retry(url, params, verify=True))
 
 
     def create_csv(self, get_date:str) -> pd.DataFrame:
@@ -48,45 +134,212 @@ class GetData:
         return pd.DataFrame(json_data["results"])
 
 
-    def get_finance_data(self, id_name_list:list) -> Tuple[Path, Path]:
-        file_path_list = []
-        max_retries = 3
+    def backfill_meta_data(self, start_date:str, end_date:str, meta_store:MetaStore) -> dict:
+        '''期間内の書類一覧を並列に習得してMetaStoreに保存する
 
-        for id in id_name_list:
-            url = f"https://disclosure.edinet-fsa.go.jp/api/v2/documents/{id}"
-            params = {"type": 5,  # csvは５
-                      "Subscription-Key":self.api}
+        取り込み済みの日付は飛ばす。その日のうちに習得した日付は取り込み済みにならないため、もう一度習得する。
 
-            if not Path('./company_finance_data').exists():
-                Path('./company_finance_data').mkdir()
+        :param start_date: str: 開始日 '%Y-%m-%d'
+        :param end_date: str: 終了日 '%Y-%m-%d'
+        :param meta_store: MetaStore:
+        :return: dict: {日付: 件数}（失敗した日付は含まない）
+        '''
 
-            if not Path(f'./company_finance_data/{id}').exists():
-                Path(f'./company_finance_data/{id}').mkdir()
+        start = datetime.strptime(start_date, '%Y-%m-%d').date()
+        end = min(datetime.strptime(end_date, '%Y-%m-%d').date(), datetime.today().date())
+        synced = meta_store.synced_dates()
 
-            file_path = Path(f'./company_finance_data/{id}/')
-            for attempt in range(max_retries):
+        dates = []
+        day = start
+        while day <= end:
+            if day.strftime('%Y-%m-%d') not in synced:
+                dates.append(day.strftime('%Y-%m-%d'))
+            day += timedelta(days=1)
+        print(f"{len(dates)}日分の書類一覧を習得します（{len(synced)}日分は取り込み済み）")
+
+        counts = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            futures = {executor.submit(self.get_company_meta_data, get_date): get_date for get_date in dates}
+            for future in as_completed(futures):
+                get_date = futures[future]
                 try:
-                    res = requests.get(url, params=params, verify=False)
-                    res.raise_for_status()
-                    with zipfile.ZipFile(io.BytesIO(res.content)) as z:
-                        for file in z.namelist():
-                            if file.startswith("XBRL_TO_CSV/jpcrp") or file.startswith("XBRL_TO_CSV/jpsps"):
-                                if file.endswith(".csv"):
-                                    z.extract(file, file_path)
-                    time.sleep(5)  # 適切な待機時間を設定
+                    json_data = future.result()
+                    if "results" not in json_data:
+                        raise ValueError(json_data.get("metadata", json_data))
+                    counts[get_date] = meta_store.upsert(pd.DataFrame(json_data["results"]), get_date)
+                except Exception as e:
+                    print(f"エラーが発生しました {get_date}: {e}")
 
-                    # ファイルをPriorとCurrentに分けて保存
-                    prior_save_path, current_save_path = self.split_data_with_prior_current(file_path / file)
-                    file_path_list.append([prior_save_path, current_save_path])
+        return dict(sorted(counts.items()))
 
-                except Exception as e:
-                    print(f"エラーが発生しました {id}: {e}")
-                    if attempt < max_retries - 1:
-                        print(f"{5}秒後に再挑戦します...")
-                        time.sleep(5)
-                break
 
-        return file_path_list
+    def get_finance_data(self, id_name_list:list) -> list:
+        """書類管理番号のリストから決算書類をダウンロードして、PriorとCurrentに分けて保存する
+
+        ダウンロードはスレッドプールで並列に実行し、レートリミッターでEDINETの上限を守る。
+        結果の順番はid_name_listと同じ（失敗したものは含まない）。
+
+        :param id_name_list: list: 書類管理番号のリスト
+        :return: list: [prior_save_path, current_save_path]のリスト
+        """
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            results = list(executor.map(self._download_document, id_name_list))
+
+        return [paths for paths in results if paths is not None]
+
+
+    def _download_document(self, id:str):
+        """一つの書類をダウンロードして展開する（失敗時はNone）"""
+
+        url = f"{self.base_url}/documents/{id}"
+        params = {"type": 5,  # csvは５
+                  "Subscription-Key": self.api}
+
+        # キャッシュが有効な場合はネットワークを使わない
+        cached = self.cache.get(id)
+        if cached is not None:
+            METRICS.count("cache_hits", source="csv")
+            return cached
+
+        file_path = self.cache.doc_dir(id)
+        file_path.mkdir(parents=True, exist_ok=True)
+
+        try:
+            # 展開したファイルが壊れている場合は保存済みのZIPから修復する
+            content = self.cache.get_zip(id)
+            if content is None:
+                METRICS.count("cache_misses")
+                content = self._request_with_retry(url, params)
+            else:
+                METRICS.count("cache_hits", source="zip")
+
+            members = []
+            with zipfile.ZipFile(io.BytesIO(content)) as z:
+                for file in z.namelist():
+                    if is_target_member(file):
+                        z.extract(file, file_path)
+                        members.append(file)
+            if not members:
+                print(f"エラーが発生しました {id}: 対象のCSVがありません")
+                return None
+
+            # ファイルをPriorとCurrentに分けて保存
+            split_paths = list(self.split_data_with_prior_current(file_path / members[-1]))
+            self.cache.put(id, content, members, split_paths)
+            return split_paths
+
+        except Exception as e:
+            print(f"エラーが発生しました {id}: {e}")
+            return None
+
+
+    def get_finance_frames(self, id_name_list:list, save_csv:bool = False) -> list:
+        """書類管理番号のリストから決算書類をメモリ上で読み込み、PriorとCurrentのDataFrameを返す
+
+        ZIPから対象のCSVを直接読み込み、必要な列だけを小さい型で保持する。
+        save_csvがTrueの場合は、get_finance_dataと同じくPriorとCurrentのCSVも保存する。
+
+        :param id_name_list: list: 書類管理番号のリスト
+        :param save_csv: bool: CSVをディスクに保存するか
+        :return: list: [prior_df, current_df]のリスト（順番はid_name_listと同じ）
+        """
+
+        return list(self.get_finance_frames_by_id(id_name_list, save_csv).values())
+
+
+    def get_finance_frames_by_id(self, id_name_list:list, save_csv:bool = False) -> dict:
+        """get_finance_framesと同じく読み込み、書類管理番号をキーにして返す
+
+        :param id_name_list: list: 書類管理番号のリスト
+        :param save_csv: bool: CSVをディスクに保存するか
+        :return: dict: {書類管理番号: [prior_df, current_df]}（読み込めた書類のみ、順番はid_name_listと同じ）
+        """
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            results = list(executor.map(lambda id: self._timed_load_document_frames(id, save_csv), id_name_list))
+
+        return {id: frames for id, frames in zip(id_name_list, results) if frames is not None}
+
+
+    def _timed_load_document_frames(self, id:str, save_csv:bool):
+        with METRICS.span("download", doc_id=id):
+            return self._load_document_frames(id, save_csv)
+
+
+    def _load_document_frames(self, id:str, save_csv:bool):
+        """一つの書類をPriorとCurrentのDataFrameとして読み込む（失敗時はNone）"""
+
+        url = f"{self.base_url}/documents/{id}"
+        params = {"type": 5,  # csvは５
+                  "Subscription-Key": self.api}
+
+        try:
+            if self.fact_store is not None and not save_csv and self.fact_store.has(id):
+                METRICS.count("cache_hits", source="fact_store")
+                return list(self.fact_store.load_frames(id))
+
+            content = self.cache.get_zip(id)
+            if content is None:
+                # ZIPを保存していない展開済みの書類はCSVから読み込む
+                cached = self.cache.get(id)
+                if cached is not None:
+                    METRICS.count("cache_hits", source="csv")
+                    return [pd.read_csv(path, usecols=XBRL_COLUMNS, dtype=XBRL_DTYPES) for path in cached]
+                METRICS.count("cache_misses")
+                content = self._request_with_retry(url, params)
+            else:
+                METRICS.count("cache_hits", source="zip")
+
+            file_path = self.cache.doc_dir(id)
+            with zipfile.ZipFile(io.BytesIO(content)) as z:
+                members = [file for file in z.namelist() if is_target_member(file)]
+                if not members:
+                    print(f"エラーが発生しました {id}: 対象のCSVがありません")
+                    return None
+                with z.open(members[-1]) as f, METRICS.span("parse", doc_id=id):
+                    df = read_xbrl_csv(f, usecols=None if save_csv else XBRL_COLUMNS)
+                if save_csv:
+                    for file in members:
+                        z.extract(file, file_path)
+
+            prior_df, current_df = split_frame_with_prior_current(df)
+            if self.fact_store is not None:
+                self.fact_store.write(id, prior_df, current_df)
+            if save_csv:
+                split_paths = self._save_split(prior_df, current_df, file_path / members[-1])
+                self.cache.put(id, content, members, split_paths)
+                return [prior_df[XBRL_COLUMNS], current_df[XBRL_COLUMNS]]
+
+            self.cache.put_zip(id, content)
+            return [prior_df, current_df]
+
+        except Exception as e:
+            print(f"エラーが発生しました {id}: {e}")
+            return None
+
+
+    def _request_with_retry(self, url:str, params:dict, verify:bool = False) -> bytes:
+        """指数バックオフ（ジッター付き）で再挑戦するGETリクエスト"""
+
+        for attempt in range(self.max_retries):
+            self.rate_limiter.acquire()
+            try:
+                with METRICS.span("http", endpoint="documents.json" if url.endswith(".json") else "documents"):
+                    res = self.session.get(url, params=params, verify=verify)
+                    res.raise_for_status()
+                METRICS.count("bytes_downloaded", len(res.content))
+                return res.content
+            except requests.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                METRICS.count("http_errors", status=status or "connection")
+                retryable = status is None or status == 429 or status >= 500
+                if not retryable or attempt == self.max_retries - 1:
+                    raise
+                wait = self.backoff * (2 ** attempt) + random.uniform(0, self.backoff)
+                print(f"{url}: {round(wait, 1)}秒後に再挑戦します...")
+                METRICS.count("retries")
+                time.sleep(wait)
 
 
     def split_data_with_prior_current(self, file_path:Path) -> Tuple[Path, Path]:
@@ -97,12 +350,17 @@ class GetData:
         """
 
         df = pd.read_csv(file_path, encoding="utf-16", sep="\t")
-        prior_df = df[df['コンテキストID'].str.contains("Prior")]
+        prior_df, current_df = split_frame_with_prior_current(df)
+        return tuple(self._save_split(prior_df, current_df, file_path))
+
+
+    def _save_split(self, prior_df:pd.DataFrame, current_df:pd.DataFrame, file_path:Path) -> list:
+        """PriorとCurrentのデータをCSVとして保存する"""
+
         prior_save_path = Path(file_path.parent / f'prior_{file_path.stem}.csv')
         prior_df.to_csv(prior_save_path, index=False)
 
-        current_df = df[~df['コンテキストID'].str.contains("Prior")]
         current_save_path = Path(file_path.parent / f'current_{file_path.stem}.csv')
         current_df.to_csv(current_save_path, index=False)
 
-        return prior_save_path, current_save_path
+        return [prior_save_path, current_save_path]
@@ -0,0 +1,432 @@
+import argparse
+import re
+import sqlite3
+import threading
+import time
+import pandas as pd
+from datetime import datetime, timedelta
+from pathlib import Path
+from metrics import METRICS
+from llm_backends import BACKENDS
+
+
+# 財務諸表のある書類種別（有価証券報告書・四半期報告書・半期報告書とそれぞれの訂正）
+WATCH_DOC_TYPES = ['120', '130', '140', '150', '160', '170']
+
+EDINET_CODE_PATTERN = re.compile(r"^E\d{5}$")
+
+# ダウンロードに失敗した書類を処理する回数の上限（超えた場合は download_gave_up にして再挑戦しない）
+MAX_ATTEMPTS = 3
+
+
+class WatchlistState:
+    '''監視する会社（edinetCode）ごとに最後に処理した書類を保存する
+
+    処理した書類はseen_docsに記録し、次の書類一覧との差分から新しい書類と訂正（parentDocID）を見つける。
+    ダウンロードに失敗した書類はMAX_ATTEMPTS回まで次の実行で再挑戦する。
+    '''
+
+    def __init__(self, db_path: str = './pipeline_state/watchlist.sqlite3') -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS watch (edinetCode TEXT PRIMARY KEY, filerName TEXT, "
+                              "lastDocID TEXT, lastSubmitDateTime TEXT, updated REAL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS seen_docs (docID TEXT PRIMARY KEY, edinetCode TEXT, "
+                              "submitDateTime TEXT, parentDocID TEXT, status TEXT, filerName TEXT, "
+                              "docTypeCode TEXT, attempts INTEGER)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS synced_dates (date TEXT PRIMARY KEY, changes INTEGER, "
+                              "complete INTEGER)")
+            # 以前の状態のファイルに列を加える
+            self._add_columns("seen_docs", {"filerName": "TEXT", "docTypeCode": "TEXT", "attempts": "INTEGER"})
+            # completeの無い日付はいつ確認したか分からないため、一度だけ確認し直す
+            self._add_columns("synced_dates", {"complete": "INTEGER"})
+
+
+    def _add_columns(self, table: str, columns: dict) -> None:
+        existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+        for name, column_type in columns.items():
+            if name not in existing:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+
+    def watched(self) -> dict:
+        '''監視している会社
+
+        :return: dict: {edinetCode: {"filerName", "lastDocID", "lastSubmitDateTime"}}
+        '''
+
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT edinetCode, filerName, lastDocID, lastSubmitDateTime FROM watch").fetchall()
+        return {code: {"filerName": name, "lastDocID": doc_id, "lastSubmitDateTime": submitted}
+                for code, name, doc_id, submitted in rows}
+
+
+    def add(self, edinet_codes: dict) -> None:
+        '''監視する会社を加える（登録済みの状態は変えない）
+
+        :param edinet_codes: dict: {edinetCode: filerName}
+        :return: None
+        '''
+
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO watch (edinetCode, filerName) VALUES (?, ?)",
+                                  list(edinet_codes.items()))
+
+
+    def seen(self, doc_ids: list) -> set:
+        '''処理済みの書類管理番号'''
+
+        if not doc_ids:
+            return set()
+        with self.lock:
+            placeholders = ", ".join("?" * len(doc_ids))
+            rows = self.conn.execute(f"SELECT docID FROM seen_docs WHERE docID IN ({placeholders}) "
+                                     "AND status != 'download_failed'", list(doc_ids)).fetchall()
+        return {row[0] for row in rows}
+
+
+    def retries(self) -> pd.DataFrame:
+        '''ダウンロードに失敗した書類（次の実行で再挑戦する）
+
+        :return: pd.DataFrame: diff_listingと同じ列
+        '''
+
+        with self.lock:
+            df = pd.read_sql_query(
+                "SELECT s.docID, s.edinetCode, COALESCE(s.filerName, w.filerName) AS filerName, s.docTypeCode, "
+                "s.submitDateTime, s.parentDocID FROM seen_docs s LEFT JOIN watch w ON s.edinetCode = w.edinetCode "
+                "WHERE s.status = 'download_failed'", self.conn)
+        return df.assign(change=df['parentDocID'].map(lambda p: 'amended' if p else 'new'))
+
+
+    def mark_seen(self, changes: pd.DataFrame, statuses: dict) -> dict:
+        '''処理した書類を記録し、会社ごとの最後の書類を更新する
+
+        :param changes: pd.DataFrame: diff_listingの結果
+        :param statuses: dict: {docID: 状態}（download_failedの書類は次回も処理する）
+        :return: dict: {docID: 記録した状態}（MAX_ATTEMPTS回失敗した書類は download_gave_up）
+        '''
+
+        def text(value):
+            return None if value is None or pd.isna(value) else str(value)
+
+        rows = [r for r in changes.itertuples(index=False) if r.docID in statuses]
+        recorded = {}
+        with self.lock, self.conn:
+            for r in rows:
+                previous = self.conn.execute("SELECT attempts FROM seen_docs WHERE docID = ?", (r.docID,)).fetchone()
+                attempts = (previous[0] or 0) + 1 if previous else 1
+                status = statuses[r.docID]
+                if status == 'download_failed' and attempts >= MAX_ATTEMPTS:
+                    print(f"{r.docID}は{attempts}回ダウンロードに失敗したため再挑戦しません")
+                    status = 'download_gave_up'
+                recorded[r.docID] = status
+
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO seen_docs (docID, edinetCode, submitDateTime, parentDocID, status, "
+                    "filerName, docTypeCode, attempts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (r.docID, r.edinetCode, r.submitDateTime, r.parentDocID, status, text(r.filerName),
+                     text(r.docTypeCode), attempts))
+                if status in ('download_failed', 'download_gave_up'):
+                    continue
+                # 提出日時が新しい場合のみ最後の書類を更新する
+                self.conn.execute(
+                    "UPDATE watch SET lastDocID = ?, lastSubmitDateTime = ?, updated = ? WHERE edinetCode = ? "
+                    "AND (lastSubmitDateTime IS NULL OR lastSubmitDateTime <= ?)",
+                    (r.docID, r.submitDateTime, time.time(), r.edinetCode, r.submitDateTime))
+        return recorded
+
+
+    def synced_dates(self) -> dict:
+        '''確認した日付と、その日が終わった後に確認したか
+
+        :return: dict: {日付: bool}（Falseの日付は書類が増えている可能性がある）
+        '''
+
+        with self.lock:
+            return {date: bool(complete) for date, complete in
+                    self.conn.execute("SELECT date, complete FROM synced_dates")}
+
+
+    def mark_synced(self, get_date: str, changes: int, fetched_at: datetime = None) -> None:
+        '''確認した日付を記録する
+
+        :param get_date: str: 日付 '%Y-%m-%d'
+        :param changes: int: 差分の件数
+        :param fetched_at: datetime: 書類一覧を習得した日時（Noneは現在）
+        :return: None
+        '''
+
+        fetched_at = fetched_at or datetime.now()
+        complete = int(fetched_at.date() > datetime.strptime(get_date, '%Y-%m-%d').date())
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO synced_dates (date, changes, complete) VALUES (?, ?, ?)",
+                              (get_date, changes, complete))
+
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def resolve_edinet_codes(targets: list, meta_store=None) -> dict:
+    '''会社名かEDINETコードのリストをEDINETコードにする
+
+    :param targets: list: 会社名かEDINETコード
+    :param meta_store: MetaStore: 会社名を検索する索引
+    :return: dict: {edinetCode: filerName}
+    '''
+
+    codes = {}
+    for target in targets:
+        target = target.strip()
+        if not target:
+            continue
+        if EDINET_CODE_PATTERN.match(target):
+            codes.setdefault(target, None)
+            continue
+        df = meta_store.query(filer_name=target) if meta_store is not None else pd.DataFrame()
+        if df.empty or df["edinetCode"].isna().all():
+            print(f"EDINETコードが見つかりません: {target}")
+            continue
+        codes[df["edinetCode"].dropna().iloc[0]] = target
+    return codes
+
+
+def diff_listing(listing: pd.DataFrame, state: WatchlistState, doc_types: list = WATCH_DOC_TYPES) -> pd.DataFrame:
+    '''書類一覧から監視している会社の未処理の書類を取り出す
+
+    :param listing: pd.DataFrame: GetData.create_csvの結果
+    :param state: WatchlistState:
+    :param doc_types: list: 対象の書類種別コード
+    :return: pd.DataFrame: docID・edinetCode・filerName・docTypeCode・submitDateTime・parentDocID・change（new/amended）
+    '''
+
+    columns = ['docID', 'edinetCode', 'filerName', 'docTypeCode', 'submitDateTime', 'parentDocID', 'change']
+    if listing.empty or "docID" not in listing.columns:
+        return pd.DataFrame(columns=columns)
+
+    df = listing.reindex(columns=columns[:-1] + ['csvFlag', 'withdrawalStatus'])
+    df['parentDocID'] = df['parentDocID'].astype(object).where(df['parentDocID'].notna(), None)
+
+    # CSVから読み込んだ場合は数値になっているため、数値で比べる
+    def as_number(column):
+        return pd.to_numeric(df[column], errors='coerce')
+
+    is_target = (df['edinetCode'].isin(list(state.watched()))
+                 & as_number('docTypeCode').isin([int(t) for t in doc_types])
+                 & (as_number('csvFlag') == 1)
+                 & (as_number('withdrawalStatus').fillna(0) == 0))
+    df = df[is_target]
+
+    df = df[~df['docID'].isin(state.seen(df['docID'].tolist()))]
+    df = df.assign(change=df['parentDocID'].map(lambda p: 'amended' if p else 'new'))
+    return df[columns].sort_values('submitDateTime', kind='stable').reset_index(drop=True)
+
+
+def run_watchlist(get_data, state: WatchlistState, pipeline, dates: list, meta_store=None) -> pd.DataFrame:
+    '''日付ごとの書類一覧の差分だけをパイプラインで処理する
+
+    ダウンロードに失敗した書類は処理済みにしないため、次回の実行の最初にもう一度処理する（MAX_ATTEMPTS回まで）。
+
+    :param get_data: GetData:
+    :param state: WatchlistState:
+    :param pipeline: pipeline.Pipeline: ダウンロード・抽出・分析
+    :param dates: list: 書類一覧を確認する日付 '%Y-%m-%d'
+    :param meta_store: MetaStore: 書類一覧の索引（Noneは保存しない）
+    :return: pd.DataFrame: 処理した書類（diff_listingの列とstatus）
+    '''
+
+    processed = []
+
+    def process(changes):
+        results = pipeline.run(changes['docID'].tolist())
+        statuses = {}
+        for doc_id, stages in results.items():
+            if stages.get('download') == 'failed':
+                statuses[doc_id] = 'download_failed'
+            else:
+                statuses[doc_id] = stages.get('analyze') or stages.get('extract') or 'unknown'
+        statuses = state.mark_seen(changes, statuses)
+        processed.append(changes.assign(status=changes['docID'].map(statuses)))
+
+    retries = state.retries()
+    if not retries.empty:
+        print(f"前回ダウンロードに失敗した書類{len(retries)}件を再挑戦します")
+        process(retries)
+
+    for get_date in dates:
+        fetched_at = datetime.now()
+        listing = get_data.create_csv(get_date)
+        if meta_store is not None:
+            meta_store.upsert(listing, get_date)
+
+        changes = diff_listing(listing, state)
+        METRICS.count("watchlist_changes", len(changes))
+        print(f"{get_date}: 監視している会社の新しい書類{(changes['change'] == 'new').sum()}件、"
+              f"訂正{(changes['change'] == 'amended').sum()}件")
+
+        if not changes.empty:
+            process(changes)
+        state.mark_synced(get_date, len(changes), fetched_at)
+
+    if not processed:
+        return pd.DataFrame()
+    return pd.concat(processed, ignore_index=True)
+
+
+def pending_dates(state: WatchlistState, since: str = None, until: str = None) -> list:
+    '''確認する日付
+
+    sinceが無い場合は、その日が終わる前に確認した日付（今日を含む）と、
+    最後に確認を終えた日の次の日からを確認する。
+
+    :param state: WatchlistState:
+    :param since: str: 開始日 '%Y-%m-%d'
+    :param until: str: 終了日 '%Y-%m-%d'（Noneは今日）
+    :return: list
+    '''
+
+    today = datetime.today().date()
+    end = min(datetime.strptime(until, '%Y-%m-%d').date(), today) if until else today
+    synced = state.synced_dates()
+    complete = {date for date, is_complete in synced.items() if is_complete}
+    if since:
+        start = datetime.strptime(since, '%Y-%m-%d').date()
+    elif synced:
+        candidates = [date for date, is_complete in synced.items() if not is_complete]
+        if complete:
+            candidates.append((datetime.strptime(max(complete), '%Y-%m-%d').date()
+                               + timedelta(days=1)).strftime('%Y-%m-%d'))
+        start = min(datetime.strptime(min(candidates), '%Y-%m-%d').date(), end)
+    else:
+        start = end
+
+    dates = []
+    day = start
+    while day <= end:
+        if day.strftime('%Y-%m-%d') not in complete:
+            dates.append(day.strftime('%Y-%m-%d'))
+        day += timedelta(days=1)
+    return dates
+
+
+def parse_args() -> argparse:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        help="監視に加える会社名かEDINETコード",
+    )
+    parser.add_argument(
+        "--watchlist",
+        "-w",
+        type=str,
+        help="一行に一つの会社名かEDINETコードを書いたファイル",
+        required=False,
+    )
+    parser.add_argument(
+        "--since",
+        type=str,
+        help="書類一覧を確認する開始日 '%%Y-%%m-%%d'（ない場合は前回の続きから）",
+        required=False,
+    )
+    parser.add_argument(
+        "--until",
+        type=str,
+        help="書類一覧を確認する終了日 '%%Y-%%m-%%d'（ない場合は今日）",
+        required=False,
+    )
+    parser.add_argument(
+        "--analysis",
+        type=str,
+        choices=['agent', 'facts', 'none'],
+        default="agent",
+        help="LLMの分析方法（none: 比率の計算まで）",
+        required=False,
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        default="fp16",
+        help="LLMの推論方法",
+        required=False,
+    )
+    parser.add_argument(
+        "--max_workers",
+        "-mw",
+        type=int,
+        default=4,
+        help="書類ダウンロードの並列数",
+        required=False,
+    )
+    parser.add_argument(
+        "--state",
+        type=str,
+        default="./pipeline_state/watchlist.sqlite3",
+        help="監視の状態の保存先",
+        required=False,
+    )
+    parser.add_argument(
+        "--edinet_url",
+        type=str,
+        default="https://disclosure.edinet-fsa.go.jp/api/v2",
+        help="EDINET APIのURL（edinet_stub.pyを使う場合は http://127.0.0.1:8766/api/v2）",
+        required=False,
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="段階ごとの時間とカウンターの保存先（.promはPrometheus、それ以外はJSON Lines）",
+        required=False,
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from api_config import EDINET_API, HF_API_KEY
+    from cache import DocumentCache
+    from meta_store import MetaStore
+    from pipeline import Pipeline, Checkpoint
+    from utils import GetData
+
+    args = parse_args()
+
+    targets = list(args.targets)
+    if args.watchlist:
+        with open(args.watchlist, encoding="utf-8") as f:
+            targets.extend(line.strip() for line in f)
+
+    meta_store = MetaStore()
+    meta_store.import_csv_folder()
+    state = WatchlistState(args.state)
+    state.add(resolve_edinet_codes(targets, meta_store))
+    if not state.watched():
+        print("監視している会社がありません（会社名かEDINETコードを指定してください）")
+        exit()
+
+    analyzer = None
+    if args.analysis != 'none':
+        from llm_analyzer import LLMAnalyzer
+        analyzer = LLMAnalyzer(HF_API_KEY, backend=args.backend)
+
+    # ダウンロードのスレッドがセッションを共有するため、コネクションプールもスレッドの数にする
+    get_data_utilis = GetData(EDINET_API, max_workers=args.max_workers, cache=DocumentCache(),
+                              base_url=args.edinet_url)
+    pipeline = Pipeline(get_data_utilis, analyzer, Checkpoint(), analysis=args.analysis,
+                        download_workers=args.max_workers)
+
+    dates = pending_dates(state, args.since, args.until)
+    print(f"{len(state.watched())}社を監視し、{len(dates)}日分の書類一覧を確認します")
+    processed = run_watchlist(get_data_utilis, state, pipeline, dates, meta_store)
+
+    if not processed.empty:
+        print(processed[['docID', 'filerName', 'docTypeCode', 'change', 'status']].to_string(index=False))
+    if args.metrics:
+        print(f"計測結果を保存しました: {METRICS.export(args.metrics)}")